@@ -0,0 +1,130 @@
+import os
+import time
+import asyncio
+import weakref
+import traceback
+import multiprocessing
+from collections import namedtuple
+import utils
+from solve import find_solution, findRuleFor, ruleStatus
+
+## Asyncio API around the solver, for embedding it in an event loop (such as
+## a web backend). Each job runs in its own worker process, so deadlines set
+## with asyncio.wait_for and task cancellation terminate the solver itself.
+
+# status is one of 'SAT', 'UNSAT', 'UND', 'TIMEOUT' or 'ERROR'. rule is the
+# (first) decimal rule found, rules all of them, seconds the wall time.
+SolveResult = namedtuple('SolveResult', ['nCubeTypes', 'nColors', 'status', 'rule', 'rules', 'log', 'seconds'])
+
+def jobWorker(conn, fn, args):
+    """ runs fn(*args) in a worker process and sends (ok, return value or error) back over conn """
+    try:
+        conn.send((True, fn(*args)))
+    except Exception as error:
+        conn.send((False, '{}\n{}'.format(error, traceback.format_exc())))
+    finally:
+        conn.close()
+
+class SolverPool:
+    """
+    Runs solver jobs in worker processes, at most nProcesses at a time.
+    A job that is cancelled (or runs past an asyncio.wait_for deadline)
+    has its process terminated, and frees its slot for the next job.
+    """
+    def __init__(self, nProcesses=None):
+        self.nProcesses = nProcesses or os.cpu_count()
+        self.semaphore = asyncio.Semaphore(self.nProcesses)
+
+    async def run(self, fn, *args):
+        """ awaits fn(*args) run in a worker process. Errors in it are raised as RuntimeError """
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            recv, send = multiprocessing.Pipe(duplex=False)
+            # Not daemonic, so that a job can race solvers in processes of its own
+            # (see polysat.solve_portfolio). It is always terminated below
+            process = multiprocessing.Process(target=jobWorker, args=(send, fn, args))
+            process.start()
+            send.close()
+            done = loop.create_future()
+            def onReadable():
+                loop.remove_reader(recv.fileno())
+                if done.done():
+                    return
+                try:
+                    done.set_result(recv.recv())
+                except EOFError:
+                    done.set_exception(RuntimeError('Solver process exited with code {}'.format(process.exitcode)))
+            loop.add_reader(recv.fileno(), onReadable)
+            try:
+                ok, value = await done
+            finally:
+                loop.remove_reader(recv.fileno())
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+                recv.close()
+            if not ok:
+                raise RuntimeError(value)
+            return value
+
+def findDecSolutions(*args):
+    """ find_solution, with the rules as decimal rules (which can be sent between processes) """
+    result = find_solution(*args)
+    if result in ('TIMEOUT', 'ERROR'):
+        return result
+    return [utils.ruleToDec(rule) for rule in result]
+
+# Default pool per event loop, as the pool's semaphore belongs to one loop
+defaultPools = weakref.WeakKeyDictionary()
+
+def getDefaultPool():
+    loop = asyncio.get_running_loop()
+    if loop not in defaultPools:
+        defaultPools[loop] = SolverPool()
+    return defaultPools[loop]
+
+async def findRuleForAsync(top, nCubeTypes, nColors, nSolutions=100, nDim=3, torsionalPatches=True, pool=None, portfolio=False):
+    """Async version of solve.findRuleFor
+
+    Args:
+        top: Topology, as a list of bindings
+        nCubeTypes (int): Number of species
+        nColors (int): Number of colors
+        nSolutions (int, optional): Number of solutions to try if they are UND. Defaults to 100.
+        pool (SolverPool, optional): Pool to run in. Defaults to a shared pool with one process per CPU.
+        portfolio (bool, optional): Race several SAT solvers (see polysat.solve_portfolio). Defaults to False.
+
+    Returns:
+        SolveResult: With status 'SAT' only for a bounded and deterministic rule
+    """
+    pool = pool or getDefaultPool()
+    start = time.time()
+    try:
+        i, rule, log = await pool.run(findRuleFor, top, nCubeTypes, nColors, nSolutions, nDim, torsionalPatches, portfolio)
+    except RuntimeError as error:
+        return SolveResult(nCubeTypes, nColors, 'ERROR', None, [], str(error), time.time() - start)
+    status = ruleStatus(rule)
+    valid = rule if status == 'SAT' else None
+    return SolveResult(nCubeTypes, nColors, status, valid, [valid] if valid else [], log, time.time() - start)
+
+async def findSolutionAsync(top, nCubeTypes, nColors, nSolutions=1, nDim=3, torsionalPatches=True, pool=None, portfolio=False):
+    """Async version of solve.find_solution. Rules are not checked for being
+    bounded and deterministic. With portfolio, a single solution is found by
+    racing several SAT solvers.
+
+    Returns:
+        SolveResult: With all nSolutions rules found (as decimal rules)
+    """
+    pool = pool or getDefaultPool()
+    start = time.time()
+    try:
+        result = await pool.run(findDecSolutions, top, nCubeTypes, nColors, nSolutions, nDim, torsionalPatches, portfolio)
+    except RuntimeError as error:
+        return SolveResult(nCubeTypes, nColors, 'ERROR', None, [], str(error), time.time() - start)
+    if result in ('TIMEOUT', 'ERROR'):
+        return SolveResult(nCubeTypes, nColors, result, None, [], '', time.time() - start)
+    rules = result
+    return SolveResult(
+        nCubeTypes, nColors, 'SAT' if rules else 'UNSAT',
+        rules[0] if rules else None, rules, '', time.time() - start
+    )
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import glob
+import time
+import threading
+import utils
+from solve import MinimalRuleSearch, MemoryBudget, runSearches
+
+## Find the minimal rule for a whole library of shapes, with one shared pool
+
+def readRecords(outPath):
+    """Read the results of an earlier (possibly interrupted) batch run
+
+    Args:
+        outPath (str): Path to the JSONL output of batchSolve
+
+    Returns:
+        tuple: Results per (shape, nCubeTypes, nColors) and the final records per finished shape
+    """
+    points = {}
+    finished = {}
+    if os.path.exists(outPath):
+        with open(outPath, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line may only be partly written if the run was killed
+                    continue
+                if 'minimalRule' in record:
+                    finished[record['shape']] = record
+                else:
+                    points[(record['shape'], record['nCubeTypes'], record['nColors'])] = record['result']
+    return points, finished
+
+def batchSolve(shapes, outPath, nSolutions=100, nProcesses=None, maxCubeTypes='auto', maxColors='auto', memoryBudget='auto', portfolio=False):
+    """Find the minimal rule for each shape, running the (shape, nCubeTypes,
+    nColors) jobs of all shapes on one worker pool, cheapest jobs first.
+    Each result is appended to outPath as a line of JSON, and shapes and
+    results already in it are not solved again, so an interrupted run can
+    be resumed by running it again.
+
+    Args:
+        shapes: A directory of shape JSON files, a glob pattern, or a list of paths
+        outPath (str): JSONL file to append results to
+        nSolutions (int, optional): Number of solutions to try if they are UND. Defaults to 100.
+        nProcesses (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        maxCubeTypes (int, optional): Maximum number of species. Defaults to 'auto'.
+        maxColors (int, optional): Maximum number of colors. Defaults to 'auto'.
+        memoryBudget (float, optional): Memory in MB that the jobs may use at the same time (see MemoryBudget). Defaults to 'auto'.
+        portfolio (bool, optional): Race several SAT solvers in each job (see polysat.solve_portfolio). Defaults to False.
+
+    Returns:
+        dict: Minimal rule (or None) per shape path
+    """
+    if isinstance(shapes, str):
+        if os.path.isdir(shapes):
+            shapes = os.path.join(shapes, '*.json')
+        shapes = sorted(glob.glob(shapes))
+    nProcesses = nProcesses or os.cpu_count()
+
+    points, finished = readRecords(outPath)
+    minimalRules = {path: record['minimalRule'] for path, record in finished.items()}
+    print("{} shapes, {} already solved".format(len(shapes), len(set(shapes) & set(finished))), flush=True)
+
+    lock = threading.Lock()
+    changed = threading.Event()
+    budget = MemoryBudget(memoryBudget)
+    searches = {}
+    for path in shapes:
+        if path in finished:
+            continue
+        with open(path, 'r') as f:
+            solveSpec = json.loads(f.read())
+        maxNT, maxNC = utils.countParticlesAndBindings(solveSpec['bindings'])
+        if maxCubeTypes != 'auto':
+            maxNT = min(maxNT, maxCubeTypes)
+        if maxColors != 'auto':
+            maxNC = min(maxNC, maxColors)
+        search = MinimalRuleSearch(
+            solveSpec['bindings'], maxNT, maxNC, nSolutions,
+            solveSpec['nDim'], solveSpec['torsion'], nProcesses,
+            verbose=False, lock=lock, changed=changed, budget=budget, portfolio=portfolio
+        )
+        # Resume from the results of an earlier run
+        for key in search.pending:
+            result = points.get((path,) + key, 'TIMEOUT')
+            if result not in ('TIMEOUT', 'ERROR', 'MEM'):
+                search.results[key] = result
+        search.pending = [k for k in search.pending if k not in search.results and not search.dominated(*k)]
+        search.check_settled()
+        searches[path] = search
+
+    paths = {search: path for path, search in searches.items()}
+    written = {path: set(search.results) for path, search in searches.items()}
+    start = time.time()
+
+    def onProgress(finished):
+        for path, search in searches.items():
+            for key in search.results.keys() - written[path]:
+                out.write(json.dumps({
+                    'shape': path, 'nCubeTypes': key[0], 'nColors': key[1],
+                    'result': search.results[key], 'implied': key in search.implied
+                }) + '\n')
+                written[path].add(key)
+        for search in finished:
+            path = paths[search]
+            # Points left out for memory that could have held a smaller rule
+            out.write(json.dumps({
+                'shape': path, 'minimalRule': search.finalResult,
+                'unproven': search.unproven, 'elapsed': time.time() - start
+            }) + '\n')
+            minimalRules[path] = search.finalResult
+            del searches[path]
+            print("{}: {}{} ({} left)".format(
+                path, search.finalResult or 'Sorry, no solution',
+                ' (not proven minimal)' if search.unproven else '', len(searches)
+            ), flush=True)
+        out.flush()
+
+    with open(outPath, 'a') as out:
+        if searches:
+            runSearches(list(searches.values()), nProcesses, onProgress)
+    return minimalRules
+
+if __name__ == '__main__':
+    portfolio = '--portfolio' in sys.argv
+    if portfolio:
+        sys.argv.remove('--portfolio')
+    if len(sys.argv) > 2:
+        batchSolve(sys.argv[1], sys.argv[2], nProcesses=int(sys.argv[3]) if len(sys.argv) > 3 else None, portfolio=portfolio)
+    else:
+        print("Need to provide a shape directory or glob and an output path [shapes, results.jsonl, nProcesses] [--portfolio]")
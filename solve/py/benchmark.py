@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import platform
+import multiprocessing
+from polycubeSolver import polysat
+from telemetry import JobTelemetry
+
+## Encoding and solving benchmarks on a fixed set of bundled shapes, so that
+## every encoding or solver change can be measured on the same points
+
+shapesDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shapes')
+defaultBaselinePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarkBaseline.json')
+
+# (shape, nCubeTypes, nColors), with shape relative to shapesDir
+benchmarkPoints = [
+    ('tripod.json', 2, 1),
+    ('cross.json', 2, 2),
+    ('letter_J.json', 3, 2),
+    ('human.json', 3, 3),
+    ('wolf.json', 3, 3),
+    ('werewolf.json', 4, 4),
+    ('filled_cube.json', 3, 3),
+    ('filled_cube.json', 5, 5),
+    ('filled_cube_no_torsion.json', 3, 3),
+    ('flowerball-torsion.json', 2, 2),
+    ('scaling/cube2.json', 2, 2),
+    ('scaling/cube3.json', 3, 3),
+    ('scaling/cube4.json', 2, 2),
+    ('scaling/cube5.json', 2, 2),
+    ('scaling/cube6.json', 1, 1),
+    ('scaling/cube7.json', 1, 1),
+    ('scaling2D/square4_2d.json', 3, 3),
+    ('scaling2D/square4_3d.json', 2, 2),
+    ('scaling2D/square6_2d.json', 2, 2),
+    ('scaling2D/square6_3d.json', 2, 2),
+    ('scaling2D/square8_2d.json', 3, 3),
+    ('scaling2D/square8_3d.json', 2, 2),
+]
+
+# Record fields that are stored in the baseline
+baselineFields = [
+    'variables', 'clauses', 'clauseFamilies', 'encodingSeconds',
+    'solverSeconds', 'peakRSSMB', 'status'
+]
+
+def pointKey(shape, nCubeTypes, nColors):
+    return '{}:{}t:{}c'.format(shape, nCubeTypes, nColors)
+
+def benchmarkPoint(shape, nCubeTypes, nColors, timeout=600):
+    """ encodes and solves one point, returning its telemetry record """
+    with open(os.path.join(shapesDir, shape), 'r') as f:
+        solveSpec = json.loads(f.read())
+    telemetry = JobTelemetry(path=None, shape=shape, nCubeTypes=nCubeTypes, nColors=nColors)
+    with telemetry.timed('encodingSeconds'):
+        mysat = polysat(solveSpec['bindings'], nCubeTypes, nColors, solveSpec['nDim'], solveSpec['torsion'])
+    telemetry.encoded(mysat)
+    with telemetry.timed('solverSeconds'):
+        result, _ = mysat.solve(timeout)
+    status = 'TIMEOUT' if result == 'TIMEOUT' else 'SAT' if result else 'UNSAT'
+    return telemetry.finish(status=status)
+
+def runBenchmarks(points=benchmarkPoints, repeats=1, timeout=600, verbose=True):
+    """Run the benchmark points one at a time, each in a fresh process so
+    that its peak memory is its own.
+
+    Args:
+        points (list, optional): (shape, nCubeTypes, nColors) tuples. Defaults to benchmarkPoints.
+        repeats (int, optional): Number of runs per point, of which the fastest is kept. Defaults to 1.
+        timeout (int, optional): Solver timeout per run, in seconds. Defaults to 600.
+
+    Returns:
+        dict: Record per point key (see pointKey), with the baselineFields
+    """
+    results = {}
+    with multiprocessing.Pool(1, maxtasksperchild=1) as p:
+        for point in points:
+            runs = [p.apply(benchmarkPoint, point + (timeout,)) for _ in range(repeats)]
+            best = min(runs, key=lambda r: r['encodingSeconds'] + r['solverSeconds'])
+            record = {k: best[k] for k in baselineFields}
+            record['encodingSeconds'] = min(r['encodingSeconds'] for r in runs)
+            record['solverSeconds'] = min(r['solverSeconds'] for r in runs)
+            record['peakRSSMB'] = min(r['peakRSSMB'] for r in runs)
+            results[pointKey(*point)] = record
+            if verbose:
+                print("{}: {} variables, {} clauses, encoded in {:.2f}s, {} in {:.2f}s, {:.0f} MB".format(
+                    pointKey(*point), record['variables'], record['clauses'], record['encodingSeconds'],
+                    record['status'], record['solverSeconds'], record['peakRSSMB']
+                ), flush=True)
+    return results
+
+def compareToBaseline(results, baseline, timeTolerance=1.5, memoryTolerance=1.25, minSeconds=0.5, minMB=20):
+    """Compare benchmark results to a baseline. A point has regressed if its
+    formula grew, its status changed, or it got slower or used more memory
+    than the tolerance allows. Differences below minSeconds and minMB are
+    taken to be noise.
+
+    Args:
+        results (dict): As returned by runBenchmarks
+        baseline (dict): Points of a stored baseline
+
+    Returns:
+        tuple: Lists of regressions and of improvements, as messages
+    """
+    regressions = []
+    improvements = []
+    for key, new in results.items():
+        if key not in baseline:
+            improvements.append('{}: not in baseline'.format(key))
+            continue
+        old = baseline[key]
+        if new['status'] != old['status']:
+            regressions.append('{}: status {} (was {})'.format(key, new['status'], old['status']))
+        for field in ['variables', 'clauses']:
+            message = '{}: {} {} (was {})'.format(key, new[field], field, old[field])
+            if new[field] > old[field]:
+                grown = {f: (n, old['clauseFamilies'].get(f, 0)) for f, n in new['clauseFamilies'].items()
+                         if n > old['clauseFamilies'].get(f, 0)}
+                regressions.append(message + (', grown clause families: {}'.format(grown) if field == 'clauses' else ''))
+            elif new[field] < old[field]:
+                improvements.append(message)
+        for field, tolerance, minimum in [
+            ('encodingSeconds', timeTolerance, minSeconds),
+            ('solverSeconds', timeTolerance, minSeconds),
+            ('peakRSSMB', memoryTolerance, minMB)
+        ]:
+            message = '{}: {:.2f} {} (was {:.2f})'.format(key, new[field], field, old[field])
+            if new[field] > tolerance * old[field] and new[field] - old[field] > minimum:
+                regressions.append(message)
+            elif old[field] > tolerance * new[field] and old[field] - new[field] > minimum:
+                improvements.append(message)
+    return regressions, improvements
+
+def readBaseline(path=defaultBaselinePath):
+    with open(path, 'r') as f:
+        return json.loads(f.read())
+
+def recordBaseline(results, path=defaultBaselinePath):
+    """ stores results as the baseline at path, along with the machine they were measured on """
+    with open(path, 'w') as f:
+        f.write(json.dumps({
+            'machine': '{} {}, {} CPUs, Python {}'.format(platform.system(), platform.machine(), os.cpu_count(), platform.python_version()),
+            'points': results
+        }, indent=1, sort_keys=True) + '\n')
+
+if __name__ == '__main__':
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'check'
+    baselinePath = sys.argv[2] if len(sys.argv) > 2 else defaultBaselinePath
+    if mode == 'record':
+        recordBaseline(runBenchmarks(repeats=3), baselinePath)
+        print("Saved baseline to {}".format(baselinePath))
+    elif mode == 'check':
+        baseline = readBaseline(baselinePath)
+        print("Comparing to baseline measured on {}".format(baseline['machine']))
+        regressions, improvements = compareToBaseline(runBenchmarks(), baseline['points'])
+        for message in improvements:
+            print("Improved: " + message)
+        for message in regressions:
+            print("Regressed: " + message)
+        if regressions:
+            print("{} regressions".format(len(regressions)))
+            sys.exit(1)
+        print("No regressions")
+    else:
+        print("Usage: python benchmark.py [check|record] [baseline.json]")
+        sys.exit(2)
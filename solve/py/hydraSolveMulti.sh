@@ -7,6 +7,9 @@ n=$(basename "$1" .json)
 
 mkdir -p $n
 
+# Solver jobs append their timings and results here (see solvePlot.getTelemetry)
+export POLYCUBES_TELEMETRY="$(pwd)/$n/telemetry.jsonl"
+
 read -r maxNT maxNC <<< $(python -c "
 import json;
 import utils;
@@ -20,14 +23,12 @@ print(maxNT, maxNC)
 echo "Max number of cube types is $maxNT"
 echo "Max number of colors is $maxNC"
 
-for f in $(python -c "import solve; [print('{}:{}'.format(nt,nc)) for nt, nc in solve.smartEnumerate($maxNT, $maxNC)]"); do
-    IFS=':' read -r nT nC <<< "$f"
-
-    echo "Scheduling $n with $nT cube types and $nC colors"
-
-    # Pad with zeroes to make sure things are sorted correctly
-    printf -v paddedNT "%0$(echo -n $maxNT | wc -m)d" $nT
-    printf -v paddedNC "%0$(echo -n $maxNC | wc -m)d" $nC
+# Queue all species and colour combinations, and submit workers that solve
+# them until the minimal rule is known (see solveQueue.py). Workers that
+# are killed have their tasks handed out again.
+python solveQueue.py add "$n/queue.sqlite" $1 $maxNT $maxNC
 
-    addqueue -s -g $n -o "$n/${paddedNT}t_${paddedNC}c-%j.out" -c "SAT $n ${nT}t ${nC}c (1 hour)" -n 1 -m 16 /users/joakim/miniconda3/bin/python solve.py "$1 $nT $nC"
+nWorkers=${2:-8}
+for w in $(seq 1 $nWorkers); do
+    addqueue -s -g $n -o "$n/worker-%j.out" -c "SAT $n worker $w" -n 1 -m 16 /users/joakim/miniconda3/bin/python solveQueue.py "work $n/queue.sqlite"
 done
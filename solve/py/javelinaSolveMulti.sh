@@ -11,6 +11,9 @@ n=$(basename "$1" .json)
 
 mkdir -p $n
 
+# Solver jobs append their timings and results here (see solvePlot.getTelemetry)
+export POLYCUBES_TELEMETRY="$(pwd)/$n/telemetry.jsonl"
+
 #SBATCH --job-name="solve_$n"      # Name of the job in the queue
 #SBATCH --error="$n/slurm.%j.err"      # Name of stderr file
 #SBATCH --output="$n/slurm.%j.out"     # Name of the stdout file
@@ -43,26 +46,9 @@ echo "Max number of cube types is $maxNT"
 echo "Max number of colors is $maxNC"
 
 max_jobs=1
-declare -A cur_jobs=( ) # build an associative array w/ PIDs of jobs we started
-
-for f in $(python -c "import solve; [print('{}:{}'.format(nt,nc)) for nt, nc in solve.smartEnumerate($maxNT, $maxNC)]"); do
-    if (( ${#cur_jobs[@]} >= max_jobs )); then
-        wait -n # wait for at least one job to exit
-	# ...and then remove any jobs that aren't running from the table
-	for pid in "${!cur_jobs[@]}"; do
-	    kill -0 "$pid" 2>/dev/null && unset cur_jobs[$pid]
-	done
-    fi
-
-    IFS=':' read -r nT nC <<< "$f"
-
-    echo "Scheduling $n with $nT cube types and $nC colors"
-
-    # Pad with zeroes to make sure things are sorted correctly
-    printf -v paddedNT "%0$(echo -n $maxNT | wc -m)d" $nT
-    printf -v paddedNC "%0$(echo -n $maxNC | wc -m)d" $nC
-
-    # nohup python solve.py $1 $nT $nC > "$n/${paddedNT}t_${paddedNC}c.out" &
-    python solve.py $1 $nT $nC > "$n/${paddedNT}t_${paddedNC}c.out" & cur_jobs[$!]=1
 
-done
+# Queue all species and colour combinations, and solve them with max_jobs
+# workers until the minimal rule is known (see solveQueue.py)
+python solveQueue.py add "$n/queue.sqlite" $1 $maxNT $maxNC
+python solveQueue.py work "$n/queue.sqlite" $max_jobs
+python solveQueue.py status "$n/queue.sqlite"
@@ -29,24 +29,230 @@ encoding functions:
 """
 
 import os
+import io
+import gzip
+import json
+import lzma
+import time
+import inspect
+import queue
+import signal
+import threading
+import multiprocessing
 import utils
 import numpy as np
-from pysat.formula import CNF
-from pysat.solvers import Glucose4
+from pysat.solvers import Glucose4, Solver
+from pysat.card import CardEnc, EncType
+from pysat.formula import WCNF
+from pysat.examples.rc2 import RC2
 
 from threading import Timer
 
+def exit_on_signal(signum, frame):
+    raise SystemExit(128 + signum)
+
 def interrupt(s):
     print("Timeout. Interrupting solve...")
     s.interrupt()
 
+def open_output(fname, compression='auto'):
+    """ opens fname for writing text, compressed with 'gzip' or 'xz' ('auto' guesses from the file extension) """
+    if compression == 'auto':
+        compression = {'.gz': 'gzip', '.xz': 'xz'}.get(os.path.splitext(fname)[1])
+    if compression == 'gzip':
+        return gzip.open(fname, 'wt')
+    elif compression == 'xz':
+        return lzma.open(fname, 'wt')
+    elif compression is None:
+        return open(fname, 'w')
+    raise ValueError("Unknown compression {}".format(compression))
+
+def load_variable_map(path):
+    """ loads a variable map saved by polysat.save_variable_map, as a dict from variable name to number """
+    with np.load(path) as data:
+        families = [str(f) for f in data['families']]
+        table = data['table']
+    return {
+        '{}({})'.format(families[row[0]], ','.join(str(x) for x in row[1:] if x >= 0)): v + 1
+        for v, row in enumerate(table.tolist())
+    }
+
+
+def portfolio_worker(name, seed, clauses, assumptions, results):
+    """ solves the clauses with one pysat backend and puts (name, seed, outcome, model, seconds) on the results queue """
+    start = time.time()
+    try:
+        if seed:
+            clauses = clauses.shuffled(seed)
+        with Solver(name=name, bootstrap_with=clauses) as m:
+            solved = m.solve(assumptions=assumptions)
+            results.put((name, seed, solved, m.get_model() if solved else None, time.time() - start))
+    except Exception as error:
+        results.put((name, seed, 'ERROR', str(error), time.time() - start))
+
+class ClauseStore:
+    """
+    Clauses kept as one flat int32 buffer of literals, plus an offsets
+    array where clause i spans literals[offsets[i]:offsets[i+1]].
+    Behaves like a list of clauses, but without a Python object per literal.
+    """
+
+    chunkSize = 1 << 20 #: Number of literals converted to Python ints at a time when iterating
+
+    def __init__(self, capacity=1024):
+        self.literals = np.empty(capacity, dtype=np.int32)
+        self.offsets = np.zeros(capacity + 1, dtype=np.int64)
+        self.nLiterals = 0
+        self.nClauses = 0
+
+    def _reserve(self, nLiterals, nClauses):
+        """ make sure there is room for nLiterals more literals in nClauses more clauses """
+        if self.nLiterals + nLiterals > len(self.literals):
+            grown = np.empty(max(2 * len(self.literals), self.nLiterals + nLiterals), dtype=np.int32)
+            grown[:self.nLiterals] = self.literals[:self.nLiterals]
+            self.literals = grown
+        if self.nClauses + nClauses + 1 > len(self.offsets):
+            grown = np.empty(max(2 * len(self.offsets), self.nClauses + nClauses + 1), dtype=np.int64)
+            grown[:self.nClauses + 1] = self.offsets[:self.nClauses + 1]
+            self.offsets = grown
+
+    def append(self, clause):
+        clause = np.asarray(clause, dtype=np.int32).ravel()
+        self._reserve(len(clause), 1)
+        self.literals[self.nLiterals:self.nLiterals + len(clause)] = clause
+        self.nLiterals += len(clause)
+        self.nClauses += 1
+        self.offsets[self.nClauses] = self.nLiterals
+
+    def extend(self, clauses):
+        """ adds clauses from another ClauseStore, a 2D array of equally sized clauses, or any iterable of clauses """
+        if isinstance(clauses, ClauseStore):
+            self.extend_flat(clauses.literals[:clauses.nLiterals], np.diff(clauses.offsets[:clauses.nClauses + 1]))
+        elif isinstance(clauses, np.ndarray):
+            assert clauses.ndim == 2
+            nClauses, width = clauses.shape
+            self.extend_flat(clauses.ravel(), np.full(nClauses, width))
+        else:
+            clauses = [tuple(c) for c in clauses]
+            self.extend_flat(
+                np.fromiter((v for c in clauses for v in c), dtype=np.int32),
+                np.fromiter((len(c) for c in clauses), dtype=np.int64, count=len(clauses))
+            )
+
+    def extend_flat(self, literals, lengths):
+        """ adds clauses given as a flat array of literals and the length of each clause """
+        assert lengths.sum() == len(literals)
+        self._reserve(len(literals), len(lengths))
+        self.literals[self.nLiterals:self.nLiterals + len(literals)] = literals
+        self.offsets[self.nClauses + 1:self.nClauses + len(lengths) + 1] = self.nLiterals + np.cumsum(lengths)
+        self.nLiterals += len(literals)
+        self.nClauses += len(lengths)
+
+    def simplified(self, nVars, maxRounds=1000):
+        """
+        Runs unit propagation over all clauses. Returns a new ClauseStore
+        without satisfied clauses and false literals (a single empty clause
+        if there is a conflict), an int8 array with the propagated value
+        of each variable number (1 true, -1 false, 0 unknown), and the
+        index in this store of each clause of the new one (empty if there
+        is a conflict).
+        """
+        values = np.zeros(nVars + 1, dtype=np.int8)
+        literals = self.literals[:self.nLiterals]
+        lengths = np.diff(self.offsets[:self.nClauses + 1])
+        kept = np.arange(self.nClauses)
+
+        def reduce(literals, lengths, kept):
+            clauseIds = np.repeat(np.arange(len(lengths)), lengths)
+            litValues = values[np.abs(literals)] * np.sign(literals).astype(np.int8)
+            satisfied = np.zeros(len(lengths), dtype=bool)
+            satisfied[clauseIds[litValues == 1]] = True
+            keep = ~satisfied[clauseIds] & (litValues != -1)
+            lengths = np.bincount(clauseIds[keep], minlength=len(lengths))[~satisfied]
+            return literals[keep], lengths, kept[~satisfied]
+
+        literals, lengths, kept = reduce(literals, lengths, kept)
+        for _ in range(maxRounds):
+            if (lengths == 0).any():
+                break
+            starts = np.cumsum(lengths) - lengths
+            units = np.unique(literals[starts[lengths == 1]])
+            if len(units) == 0:
+                break
+            if len(np.unique(np.abs(units))) < len(units):
+                # Both v and -v are units
+                lengths = np.zeros(1, dtype=np.int64)
+                break
+            values[np.abs(units)] = np.sign(units)
+            literals, lengths, kept = reduce(literals, lengths, kept)
+
+        store = ClauseStore(max(len(literals), 1))
+        if (lengths == 0).any():
+            store.append([])
+            kept = kept[:0]
+        else:
+            store.extend_flat(literals, lengths)
+        return store, values, kept
+
+    def shuffled(self, seed):
+        """ returns a copy with the clauses in a random order, given by the seed """
+        order = np.random.default_rng(seed).permutation(self.nClauses)
+        starts = self.offsets[:self.nClauses][order]
+        lengths = np.diff(self.offsets[:self.nClauses + 1])[order]
+        # Index of every literal of the reordered clauses in the old buffer
+        index = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        store = ClauseStore(max(self.nLiterals, 1))
+        store.extend_flat(self.literals[index], lengths)
+        return store
+
+    def __len__(self):
+        return self.nClauses
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.nClauses
+        if not 0 <= i < self.nClauses:
+            raise IndexError("Clause index out of range")
+        return self.literals[self.offsets[i]:self.offsets[i+1]].tolist()
+
+    def __iter__(self):
+        return self.iter_from(0)
+
+    def iter_from(self, i):
+        """ yields each clause from index i onwards as a list of ints, converting one chunk of the buffer at a time """
+        while i < self.nClauses:
+            # Take as many whole clauses as fit in a chunk (but at least one)
+            j = int(np.searchsorted(self.offsets[:self.nClauses + 1], self.offsets[i] + self.chunkSize, side='right')) - 1
+            j = min(max(j, i + 1), self.nClauses)
+            start = self.offsets[i]
+            literals = self.literals[start:self.offsets[j]].tolist()
+            bounds = (self.offsets[i:j+1] - start).tolist()
+            for k in range(j - i):
+                yield literals[bounds[k]:bounds[k+1]]
+            i = j
+
 
 #Polycube SAT Solver
 class polysat:
     relsat_executable  = 'relsat'
     minisat_executable = 'minisat'
 
-    def __init__(self, topology, nCubeTypes, nColors, nDim=3, torsionalPatches=True, allParticles=True, allPatches=True, forbidEmptySpecies=False):
+    #: (pysat solver name, seed) pairs raced by solve_portfolio, seed 0 keeps the clause order
+    portfolio = (('cadical153', 0), ('maplechrono', 0), ('glucose4', 0), ('lingeling', 0), ('glucose4', 1), ('cadical153', 1))
+    portfolioPollSeconds = 1 #: How often solve_portfolio checks that its workers are still running
+
+    amoEncodings = ('pairwise', 'seqcounter', 'commander', 'bimander', 'ladder', 'cardenc')
+    amoPairwiseLimit = 4 #: Groups of at most this many literals always use the pairwise encoding
+    cardEncType = EncType.seqcounter #: Encoding used by pysat's CardEnc when amoEncoding='cardenc'
+
+    # Peak RSS of building and solving a formula is about 37 bytes per literal on
+    # the benchmark shapes, plus the interpreter. The margin is for learnt clauses
+    memoryBaseMB = 64 #: Resident memory of a solver process before building the formula, in MB
+    memoryPerLiteral = 64 #: Bytes of resident memory per literal of the formula, used by estimate_memory
+
+    encodingVersion = 1 #: Increase when a change to the encoding can change which solutions are found
+
+    def __init__(self, topology, nCubeTypes, nColors, nDim=3, torsionalPatches=True, allParticles=True, allPatches=True, forbidEmptySpecies=False, vectorized=True, amoEncoding='pairwise', symmetryBreaking=(), selectors=False, simplify=True):
         #topology, empty = utils.topFromFile(topPath, nDim)
 
         # Number of distinct cube types for the solver
@@ -65,16 +271,38 @@ class polysat:
         if self.torsionalPatches:
             self.nO = 4   #: Number of possible orientations for a patch, N,S,W,E
         self.rotations = utils.enumerateRotations()
-        self.nR = len(self.rotations)
+        self.nR = len(utils.rotationTable)
+
+        # Build the placement constraints as NumPy arrays rather than
+        # one clause at a time
+        self.vectorized = vectorized
 
-        self.variables = {}
-        self.basic_sat_clauses = None       #  string of s basic sat clause
+        # Encoding used for the "at most one" part of exactly-one constraints
+        if amoEncoding not in self.amoEncodings:
+            raise ValueError("Unknown at-most-one encoding '{}', expected one of {}".format(amoEncoding, self.amoEncodings))
+        self.amoEncoding = amoEncoding
+
+        self.basic_sat_clauses = None       #  ClauseStore of basic sat clauses
+        self.clauseTags = []                #  (constraint family, index of its first clause) per run of basic_sat_clauses, see tag_clauses()
         self.additional_sat_clauses = None  #  some additional conditions
         self.BCO_varlen = None               #  the number of clauses that determine B and C
+        self.solver = None                  #  live SAT solver, kept between calls to solve()
+        self.nSolverClauses = 0             #  number of basic_sat_clauses already added to the solver
+        self.portfolioStats = None          #  outcome and time per backend from the last solve_portfolio()
+        self.timedOut = False               #  whether the last enumerate_solutions() ran out of time
 
         self.set_crystal_topology(topology)
+        self.init_variable_layout()
         self.generate_constraints()
 
+        # Optional selector literals, one per species and color pair, so that
+        # fewer species and colors can be solved for using assumptions.
+        # nCubeTypes and nColors are then the maximum numbers
+        self.speciesSelectors = None
+        self.colorSelectors = None
+        if selectors:
+            self.add_selectors()
+
         if allParticles:
             # Solution must use all particles
             self.add_constraints_all_particles()
@@ -108,6 +336,23 @@ class polysat:
             self.fix_slot_colors(particle, patch, 1)
             #print("Particle {} patch {} should be empty".format(particle, patch))
 
+        # Optional lex-leader constraints, removing solutions that only
+        # differ by relabelling species or colors, or by a rotation of the shape
+        for kind in symmetryBreaking:
+            if kind == 'species':
+                self.add_constraints_species_symmetry()
+            elif kind == 'colors':
+                self.add_constraints_color_symmetry()
+            elif kind == 'shape':
+                self.add_constraints_shape_symmetry()
+            else:
+                raise ValueError("Unknown symmetry breaking '{}', expected 'species', 'colors' or 'shape'".format(kind))
+
+        if simplify:
+            # Propagate fixed facts, such as empty slots, color interactions
+            # and the hard-coded D variables, through the formula
+            self.simplify()
+
     def check_bindings(self):
         bindings = self.bindings
         pids = [x[0] for x in bindings.keys()] + [x[0] for x in bindings.values()]
@@ -135,93 +380,197 @@ class polysat:
         self.bindings = {(int(p1), int(s1)): (int(p2), int(s2)) for (p1, s1, p2, s2) in bindings}
         self.check_bindings()
 
+    def init_variable_layout(self):
+        """
+        Give every variable family a fixed offset, so that variable numbers
+        can be calculated in closed form rather than looked up by name.
+        B, C and O come first, followed by F, A, D and P. Auxiliary
+        variables (X) are allocated after that, as they are needed.
+        """
+        families = [
+            ('B', (self.nC * (self.nC + 1)) // 2),
+            ('C', self.nS * self.nP * self.nC)
+        ]
+        if self.torsionalPatches:
+            families.append(('O', self.nS * self.nP * self.nO))
+        families.append(('F', self.nL * self.nP * self.nC))
+        if self.torsionalPatches:
+            families.append(('A', self.nL * self.nP * self.nO))
+            families.append(('D', ((self.nP * (self.nP - 1)) // 2) * self.nO * self.nO))
+        families.append(('P', self.nL * self.nS * self.nR))
+
+        self.offsets = {}
+        self.nVars = 0
+        for name, size in families:
+            self.offsets[name] = self.nVars
+            self.nVars += size
+        self.families = [name for name, _ in families]
+
+        self.offsets['X'] = self.nVars
+        self.families.append('X')
+        self.nAux = 0
+
+        # Index tuples of each family, in the same order as the variable numbers
+        self.B_pairs = [(c1, c2) for c1 in range(self.nC) for c2 in range(c1, self.nC)]
+        if self.torsionalPatches:
+            self.D_pairs = [(p1, p2) for p1 in range(self.nP) for p2 in range(p1 + 1, self.nP)]
+        self.shapes = {
+            'C': (self.nS, self.nP, self.nC),
+            'F': (self.nL, self.nP, self.nC),
+            'P': (self.nL, self.nS, self.nR)
+        }
+        if self.torsionalPatches:
+            self.shapes['O'] = (self.nS, self.nP, self.nO)
+            self.shapes['A'] = (self.nL, self.nP, self.nO)
+
+    @property
+    def variables(self):
+        """ Dictionary mapping variable names, such as 'B(0,1)', to variable numbers """
+        return {self.vname(v): v for v in range(1, self.nVars + 1)}
+
     def B(self,c1, c2):
         """ color c1 binds with c2 """
         if c2 < c1:
             c1, c2 = c2, c1
         assert 0 <= c1 <= c2 < self.nC
-        #print >> sys.stderr, 'B({c1},{c2})'.format(c1=c1, c2=c2)
-        return self.variables.setdefault('B({c1},{c2})'.format(c1=c1, c2=c2), len(self.variables) + 1)
+        return self.offsets['B'] + c1 * self.nC - (c1 * (c1 - 1)) // 2 + (c2 - c1) + 1
 
     def D(self, p1, o1, p2, o2):
         """ patch p1, orientation o1 binds with patch p2, orientation o2 """
         if p2 < p1:
             o1, o2 = o2, o1
             p1, p2 = p2, p1
-        assert 0 <= p1 <= p2 < self.nP
+        assert 0 <= p1 < p2 < self.nP
         assert 0 <= o1 < self.nO
         assert 0 <= o2 < self.nO
-        return self.variables.setdefault('D({p1},{o1},{p2},{o2})'.format(p1=p1, o1=o1, p2=p2, o2=o2), len(self.variables) + 1)
+        pair = p1 * self.nP - (p1 * (p1 + 1)) // 2 + (p2 - p1 - 1)
+        return self.offsets['D'] + (pair * self.nO + o1) * self.nO + o2 + 1
 
     def F(self, l, p, c):
         """ patch p at position l has color c """
         assert 0 <= l < self.nL
         assert 0 <= p < self.nP
         assert 0 <= c < self.nC
-        return self.variables.setdefault('F({l},{p},{c})'.format(l=l, p=p, c=c), len(self.variables) + 1)
+        return self.offsets['F'] + (l * self.nP + p) * self.nC + c + 1
 
     def A(self, l, p, o):
         """ patch p at position l has orientation o """
         assert 0 <= l < self.nL
         assert 0 <= p < self.nP
         assert 0 <= o < self.nO
-        return self.variables.setdefault('A({l},{p},{o})'.format(l=l, p=p, o=o), len(self.variables) + 1)
+        return self.offsets['A'] + (l * self.nP + p) * self.nO + o + 1
 
     def C(self,s, p, c):
         """ patch p on species s has color c """
         assert 0 <= s < self.nS
         assert 0 <= p < self.nP
         assert 0 <= c < self.nC
-        return self.variables.setdefault('C({s},{p},{c})'.format(s=s, p=p, c=c), len(self.variables) + 1)
+        return self.offsets['C'] + (s * self.nP + p) * self.nC + c + 1
 
     def O(self, s, p, o):
         """ patch p on species s has orientation o """
         assert 0 <= s < self.nS
         assert 0 <= p < self.nP
         assert 0 <= o < self.nO
-        return self.variables.setdefault('O({s},{p},{o})'.format(s=s, p=p, o=o), len(self.variables) + 1)
+        return self.offsets['O'] + (s * self.nP + p) * self.nO + o + 1
 
     def P(self, l, s, r):
         """ position l is occupied by species s with rotation r """
         assert 0 <= l < self.nL
         assert 0 <= s < self.nS
         assert 0 <= r < self.nR
-        return self.variables.setdefault('P({l},{s},{r})'.format(l=l, s=s, r=r), len(self.variables) + 1)
+        return self.offsets['P'] + (l * self.nS + s) * self.nR + r + 1
+
+    def X(self, i):
+        """ auxiliary variable i, such as those introduced by at-most-one encodings """
+        assert 0 <= i < self.nAux
+        return self.offsets['X'] + i + 1
+
+    def new_var(self):
+        """ allocates a new auxiliary variable and returns its number """
+        self.nAux += 1
+        self.nVars += 1
+        return self.X(self.nAux - 1)
+
+    def decode(self, v):
+        """ returns the family name and indices of variable number v, e.g. ('B', (0, 1)) """
+        v = abs(v)
+        assert 0 < v <= self.nVars
+        family = self.families[0]
+        for name in self.families:
+            if self.offsets[name] >= v:
+                break
+            family = name
+        i = v - self.offsets[family] - 1
+        if family == 'B':
+            return family, self.B_pairs[i]
+        if family == 'D':
+            pair, i = divmod(i, self.nO * self.nO)
+            o1, o2 = divmod(i, self.nO)
+            p1, p2 = self.D_pairs[pair]
+            return family, (p1, o1, p2, o2)
+        if family == 'X':
+            return family, (i,)
+        return family, tuple(int(x) for x in np.unravel_index(i, self.shapes[family]))
+
+    def vname(self, v):
+        """ returns the name of variable number v, e.g. 'B(0,1)' """
+        family, indices = self.decode(v)
+        return '{}({})'.format(family, ','.join(str(x) for x in indices))
+
+    def vnum(self, vname):
+        """ returns the number of a variable given its name, e.g. 'B(0,1)' """
+        family = vname.strip()[0]
+        if family not in self.offsets:
+            raise IOError("Unknown variable {}, probably incompatible problem formulation?".format(vname))
+        indices = [int(x) for x in vname.strip()[2:-1].split(',')]
+        return getattr(self, family)(*indices)
 
     def rotation(self,p, r):
-        """ patch that p rotates to under rotation r """
+        """ patch that p rotates to under rotation r (see utils.rotationTable) """
         assert 0 <= p < self.nP
         assert 0 <= r < self.nR
-        # assert all(len(set(rotations[r].keys())) == nP for r in rotations)
-        # assert all(len(set(rotations[r].values())) == nP for r in rotations)
-        assert len(self.rotations) == self.nR
-        assert r in self.rotations
-        assert p in self.rotations[r]
-        return self.rotations[r][p]
+        return int(utils.rotationTable[r, p])
 
     def orientation(self,p, r, o):
-        """ new orientation for patch p with initial orientation o after getting rotated by r """
+        """ new orientation for patch p with initial orientation o after getting rotated by r (see utils.orientationTable) """
         assert 0 <= p < self.nP
         assert 0 <= r < self.nR
         assert 0 <= o < self.nO
-        assert len(self.rotations) == self.nR
-        assert r in self.rotations
-        assert p in self.rotations[r]
-
-        # Calculate patch that p rotates to:
-        p_rot = self.rotations[r][p]
-         # Calculate vector corresponding to o
-        v = utils.patchRotToVec(p, o)
-        # Which p has the same vector as o?
-        p_temp = utils.getIndexOf(v, utils.getRuleOrder())
-        assert(p != p_temp)
-        # How would that p get rotated?
-        p_temp_rot = self.rotations[r][p_temp]
-        assert(p_rot != p_temp_rot)
-        # And what vector does that correspond to?
-        v_rot = utils.getRuleOrder()[p_temp_rot]
-        # And what orientation value does that give us?
-        return utils.patchVecToRot(p_rot, v_rot)
+        return int(utils.orientationTable[r, p, o])
+
+    def var_array(self, family):
+        """ returns an int32 array with all variable numbers of the family, indexed like the variable function """
+        shape = self.shapes[family]
+        return (np.arange(np.prod(shape), dtype=np.int32) + self.offsets[family] + 1).reshape(shape)
+
+    def rotation_table(self):
+        """ returns a (read-only) array of shape (#r, #p) with the patch that p rotates to under rotation r """
+        return utils.rotationTable
+
+    def orientation_table(self):
+        """ returns a (read-only) array of shape (#r, #p, #o) with the new orientation of patch p, orientation o after rotation r """
+        return utils.orientationTable
+
+    def placement_clauses(self, positionVars, speciesVars):
+        """
+        Vectorized version of
+            for all l, s, r: P(l, s, r) => (forall p, x: positionVars[l, p, x] <=> speciesVars[s, r, p, x])
+        Returns an int32 array with one three-literal clause per row,
+        in the same order as the corresponding nested loops
+        """
+        P = self.var_array('P')[:, :, :, None, None]
+        X = positionVars[:, None, None, :, :]
+        Y = speciesVars[None, :, :, :, :]
+        shape = np.broadcast_shapes(P.shape, X.shape, Y.shape)
+        clauses = np.empty(shape + (2, 3), dtype=np.int32)
+        clauses[..., 0, 0] = -P # EITHER no species 's' at position 'l' with rot 'r'
+        clauses[..., 0, 1] = -X # OR position 'l' does not have value 'x' at patch 'p'
+        clauses[..., 0, 2] = Y  # OR rotated species 's' does have value 'x' at patch 'p'
+        clauses[..., 1, 0] = -P # EITHER no species 's' at position 'l' with rot 'r'
+        clauses[..., 1, 1] = X  # OR position 'l' has value 'x' at patch 'p'
+        clauses[..., 1, 2] = -Y # OR rotated species 's' does not have value 'x' at patch 'p'
+        return clauses.reshape(-1, 3)
 
     def check_settings(self):
         assert len(self.bindings) == (self.nL * self.nP) / 2.0
@@ -240,43 +589,102 @@ class polysat:
         """ returns a list of constraints implementing "exacly one of vs is true" """
         assert all(v > 0 for v in vs)
         assert len(vs) > 1
-        constraints = [tuple(sorted(vs))]
+        return [tuple(sorted(vs))] + self._at_most_one(vs)
+
+    def _at_most_one(self, vs):
+        """ returns a list of constraints implementing "at most one of vs is true", using the chosen amoEncoding """
+        if self.amoEncoding == 'pairwise' or len(vs) <= self.amoPairwiseLimit:
+            return self._amo_pairwise(vs)
+        return getattr(self, '_amo_' + self.amoEncoding)(list(vs))
+
+    def _amo_pairwise(self, vs):
+        """ one binary clause per pair of literals, O(k^2) clauses and no auxiliary variables """
+        constraints = []
         for v1 in sorted(vs):
             for v2 in sorted(vs):
                 if v2 >= v1:
                     break
                 constraints.append((-v1, -v2))
-        assert len(set(constraints)) == (len(vs) * (len(vs)-1)) / 2 + 1
+        assert len(set(constraints)) == (len(vs) * (len(vs)-1)) / 2
         return constraints
 
+    def _amo_seqcounter(self, vs):
+        """ sequential counter (Sinz 2005), s_i is true if any of vs[0..i] is true """
+        n = len(vs)
+        s = [self.new_var() for _ in range(n - 1)]
+        constraints = [(-vs[0], s[0])]
+        for i in range(1, n - 1):
+            constraints.append((-vs[i], s[i]))
+            constraints.append((-s[i-1], s[i]))
+            constraints.append((-vs[i], -s[i-1]))
+        constraints.append((-vs[n-1], -s[n-2]))
+        return constraints
 
-    def generate_constraints(self):
-        # make sure B, C and O vars are first:
-        for c1 in range(self.nC):
-            for c2 in range(self.nC):
-                self.B(c1, c2)
-        for s in range(self.nS):
-            for p in range(self.nP):
-                for c in range(self.nC):
-                    self.C(s, p, c)
-        if self.torsionalPatches:
-            for s in range(self.nS):
-                for p in range(self.nP):
-                    for o in range(self.nO):
-                        self.O(s, p, o)
+    def _amo_ladder(self, vs):
+        """ ladder encoding (Gent and Nightingale 2004), vs[i] true means y_j is true exactly for j < i """
+        n = len(vs)
+        y = [self.new_var() for _ in range(n - 1)]
+        constraints = [(-y[i+1], y[i]) for i in range(n - 2)]
+        for i, v in enumerate(vs):
+            if i > 0:
+                constraints.append((-v, y[i-1]))
+            if i < n - 1:
+                constraints.append((-v, -y[i]))
+        return constraints
+
+    def _amo_commander(self, vs, groupSize=3):
+        """ commander encoding (Klieber and Kwon 2007), pairwise within groups and recursively over one commander per group """
+        if len(vs) <= self.amoPairwiseLimit:
+            return self._amo_pairwise(vs)
+        constraints = []
+        commanders = []
+        for i in range(0, len(vs), groupSize):
+            group = vs[i:i+groupSize]
+            c = self.new_var()
+            commanders.append(c)
+            constraints.extend(self._amo_pairwise(group))
+            # The commander is true exactly when one of its group is
+            constraints.extend((-v, c) for v in group)
+            constraints.append(tuple([-c] + group))
+        return constraints + self._amo_commander(commanders, groupSize)
+
+    def _amo_bimander(self, vs, groupSize=2):
+        """ bimander encoding (Nguyen and Mai 2015), pairwise within groups and a binary code of the group index """
+        groups = [vs[i:i+groupSize] for i in range(0, len(vs), groupSize)]
+        nBits = (len(groups) - 1).bit_length()
+        bits = [self.new_var() for _ in range(nBits)]
+        constraints = []
+        for j, group in enumerate(groups):
+            constraints.extend(self._amo_pairwise(group))
+            for v in group:
+                for k, b in enumerate(bits):
+                    constraints.append((-v, b if (j >> k) & 1 else -b))
+        return constraints
 
+    def _amo_cardenc(self, vs):
+        """ at-most-one constraint from pysat's CardEnc, using the cardEncType encoding """
+        cnf = CardEnc.atmost(lits=vs, bound=1, top_id=self.nVars, encoding=self.cardEncType)
+        while self.nVars < cnf.nv:
+            self.new_var()
+        return [tuple(c) for c in cnf.clauses]
+
+
+    def generate_constraints(self):
         #print('c settings: nS=%d nC=%d nP=%d ' % (nS, nC, nP) )
         #print('c Last B and C var number: %s' % len(variables))
-        self.basic_sat_clauses = []
+        self.basic_sat_clauses = ClauseStore()
+        self.clauseTags = []
         #self.basic_sat_clauses.append('c settings: nS=%d nC=%d nP=%d ' % (self.nS, self.nC, self.nP) )
         #self.basic_sat_clauses.append('c Last B and C var number: %s' % len(self.variables))
-        self.BCO_varlen = len(self.variables)
-        constraints = []
+        # B, C and O vars are first in the variable layout
+        self.BCO_varlen = self.offsets['F']
+        constraints = self.basic_sat_clauses
 
         # BASIC THINGS:
         # - Legal color bindings:
         # "Each color has exactly one color that it binds to"
         # 	forall c1 exactly one c2 s.t. B(c1, c2)
+        self.tag_clauses('one_binding_color')
         for c1 in range(self.nC):
             constraints.extend(self._exactly_one([self.B(c1, c2) for c2 in range(self.nC)]))
             #print >> sys.stderr, [B(c1, c2) for c2 in range(nC) if c2 != c1]
@@ -285,6 +693,7 @@ class polysat:
         #   patch coloring"):
         # "Each patch on every species has exactly one color"
         #   forall s, forall p, exactly one c p.t. C(s, p, c)
+        self.tag_clauses('one_species_patch_color')
         for s in range(self.nS):
             for p in range(self.nP):
                 constraints.extend(self._exactly_one([self.C(s, p, c) for c in range(self.nC)]))
@@ -292,6 +701,7 @@ class polysat:
         # - Legal species patch orientation
         # "Each patch on every species has exactly one orientation"
         #   forall s, forall p, exactly one o p.t. O(s, p, o)
+        self.tag_clauses('one_species_patch_orientation')
         if self.torsionalPatches:
             for s in range(self.nS):
                 for p in range(self.nP):
@@ -302,6 +712,7 @@ class polysat:
         # - Legal position patch coloring:
         # "Every position patch has exactly one color"
         # 	for all l, p exactly one c st. F(l, p, c)
+        self.tag_clauses('one_position_patch_color')
         for l in range(self.nL):
             for p in range(self.nP):
                 constraints.extend(self._exactly_one([self.F(l, p, c) for c in range(self.nC)]))
@@ -309,6 +720,7 @@ class polysat:
         # - Legal position patch orientation:
         # "Every position patch has exactly one orientation"
         # 	for all l, p exactly one o st. A(l, p, o)
+        self.tag_clauses('one_position_patch_orientation')
         if self.torsionalPatches:
             for l in range(self.nL):
                 for p in range(self.nP):
@@ -318,6 +730,7 @@ class polysat:
         # "Specified binds have compatible colors"
         # 	forall (l1, p1) binding with (l2, p2) from shape spec:
         # 		forall c1, c2: F(l1, p1, c1) and F(l2, p2, c2) => B(c1, c2)
+        self.tag_clauses('binding_colors')
         for (l1, p1), (l2, p2) in self.bindings.items():
             for c1 in range(self.nC):
                 for c2 in range(self.nC):
@@ -327,6 +740,7 @@ class polysat:
         # "Specified binds have compatible orientations"
         # 	forall (l1, p1) binding with (l2, p2) from shape spec:
         # 		forall o1, o2: A(l1, p1, o1) and A(l2, p2, o2) => D(c1, c2)
+        self.tag_clauses('binding_orientations')
         if self.torsionalPatches:
             for (l1, p1), (l2, p2) in self.bindings.items():
                 for o1 in range(self.nO):
@@ -334,6 +748,7 @@ class polysat:
                         constraints.append((-self.A(l1, p1, o1), -self.A(l2, p2, o2), self.D(p1, o1, p2, o2)))
 
         # Hard-code patch orientations to bind only if they point in the same direction
+        self.tag_clauses('patch_orientation_bindings')
         if self.torsionalPatches:
             for p1 in range(self.nP):
                 for p2 in range(self.nP):
@@ -341,8 +756,8 @@ class polysat:
                         break
                     for o1 in range(self.nO):
                         for o2 in range(self.nO):
-                            v1 = utils.patchRotToVec(p1, o1)
-                            v2 = utils.patchRotToVec(p2, o2)
+                            v1 = utils.patchRotVecTable[p1, o1]
+                            v2 = utils.patchRotVecTable[p2, o2]
                             # Do they point in the same global direction?
                             # And do the patches face each other?
                             if np.array_equal(v1, v2) and p2%2 == 0 and p2+1 == p1:
@@ -354,6 +769,7 @@ class polysat:
         # - Legal species placement in positions:
         # "Every position has exactly one species placed there with exactly one rotation"
         #   forall l: exactly one s and r p.t. P(l, s, r)
+        self.tag_clauses('one_placement')
         for l in range(self.nL):
             constraints.extend(self._exactly_one([self.P(l, s, r) for s in range(self.nS) for r in range(self.nR)]))
 
@@ -361,31 +777,42 @@ class polysat:
         # "Given a place, species and its rotation, the patch colors on the position and (rotated) species must be the same"
         #   for all l, s, r:
         #       P(l, s, r) => (forall p, c: F(l, p, c) <=> C(s, rotation(p, r), c))
-        for l in range(self.nL):
-            for s in range(self.nS):
-                for r in range(self.nR):
-                    # forall part
-                    for p in range(self.nP):
-                        for c in range(self.nC):
-                            p_rot = self.rotation(p, r) # Patch after rotation
-                            # Species 's' rotated by 'r' gets color 'c' moved from patch 'p' to 'p_rot':
-                            constraints.append(( 
-                                -self.P(l, s, r), # EITHER no species 's' at position 'l' with rot 'r'
-                                -self.F(l, p, c), # OR no patch 'p' at position 'l' with color 'c'
-                                self.C(s, p_rot, c) # OR patch 'p_rot' on species 's' DOES have the color 'c'
-                            ))
-                            constraints.append((
-                                -self.P(l, s, r), # EITHER no species 's' at position 'l' with rot 'r'
-                                self.F(l, p, c), # OR there is a patch 'p' at position 'l' with color 'c'
-                                -self.C(s, p_rot, c) # OR there is no patch 'p_rot' on species 's' with the color 'c'
-                            ))
+        self.tag_clauses('placement_colors')
+        if self.vectorized:
+            # C(s, rotation(p, r), c), indexed [s, r, p, c]
+            rotatedC = self.var_array('C')[:, self.rotation_table(), :]
+            constraints.extend(self.placement_clauses(self.var_array('F'), rotatedC))
+        else:
+            for l in range(self.nL):
+                for s in range(self.nS):
+                    for r in range(self.nR):
+                        # forall part
+                        for p in range(self.nP):
+                            for c in range(self.nC):
+                                p_rot = self.rotation(p, r) # Patch after rotation
+                                # Species 's' rotated by 'r' gets color 'c' moved from patch 'p' to 'p_rot':
+                                constraints.append(( 
+                                    -self.P(l, s, r), # EITHER no species 's' at position 'l' with rot 'r'
+                                    -self.F(l, p, c), # OR no patch 'p' at position 'l' with color 'c'
+                                    self.C(s, p_rot, c) # OR patch 'p_rot' on species 's' DOES have the color 'c'
+                                ))
+                                constraints.append((
+                                    -self.P(l, s, r), # EITHER no species 's' at position 'l' with rot 'r'
+                                    self.F(l, p, c), # OR there is a patch 'p' at position 'l' with color 'c'
+                                    -self.C(s, p_rot, c) # OR there is no patch 'p_rot' on species 's' with the color 'c'
+                                ))
 
 
         # - Legal species patch orientation in positions:
         # "Given a place, species and its rotation, the patch orientations on the position and (rotated) species must be correct"
         #   for all l, s, r:
         #       P(l, s, r) => (forall p, c: F(l, p, c) <=> C(s, rotation(p, r), c))
-        if self.torsionalPatches:
+        self.tag_clauses('placement_orientations')
+        if self.torsionalPatches and self.vectorized:
+            # O(s, rotation(p, r), orientation(p, r, o)), indexed [s, r, p, o]
+            rotatedO = self.var_array('O')[:, self.rotation_table()[:, :, None], self.orientation_table()]
+            constraints.extend(self.placement_clauses(self.var_array('A'), rotatedO))
+        elif self.torsionalPatches:
             for l in range(self.nL):
                 for s in range(self.nS):
                     for r in range(self.nR):
@@ -406,6 +833,7 @@ class polysat:
                                     -self.O(s, p_rot, o_rot) # OR there is no patch 'p_rot' on species 's' with the orientation 'o_rot'
                                 ))
         
+        self.tag_clauses('flat_patches')
         if self.nD == 2:
             # Lock patch orientation if 2D
             for s in range(self.nS):
@@ -433,20 +861,25 @@ class polysat:
         #constraints.append([self.F(0, 0, 0)])
         #constraints.append([self.P(0, 0, 0)])
 
-        self.basic_sat_clauses.extend(constraints)
         return constraints
 
 
-    def output_cnf(self,out=None):
-        """ Outputs a CNF formula """
-        num_vars = max(self.variables.values())
+    def output_cnf(self,out=None, chunkSize=1<<16):
+        """ Outputs a CNF formula, streamed to the out handle in chunks of clauses if given, otherwise returned as a string """
+        if out is None:
+            out = io.StringIO()
+            self.output_cnf(out, chunkSize)
+            return out.getvalue()
+        num_vars = self.nVars
         num_constraints = len(self.basic_sat_clauses)
-        outstr = "p cnf %s %s\n" % (num_vars, num_constraints)
+        out.write("p cnf %s %s\n" % (num_vars, num_constraints))
+        lines = []
         for c in self.basic_sat_clauses:
-            outstr += ' '.join([str(v) for v in c]) + ' 0\n'
-        if (out is not None):
-            out.write(outstr)
-        return outstr
+            lines.append(' '.join([str(v) for v in c]) + ' 0\n')
+            if len(lines) >= chunkSize:
+                out.write(''.join(lines))
+                lines = []
+        out.write(''.join(lines))
 
 
     def load_solution_from_lines(self,lines,maxvariable=None):
@@ -462,16 +895,18 @@ class polysat:
         sols = [int(v) for v in satline]
         assert sols[-1] == 0
         sols = sols[:-1]
-        assert len(sols) <= len(self.variables)
+        assert len(sols) <= self.nVars
 
-        return [vname for vname, vnum in self.variables.items() if vnum in sols]
+        return [self.vname(v) for v in sorted(set(v for v in sols if v > 0))]
 
     def add_constraints_from_vnames(self,vnames):
         constraints = []
         for vname in vnames:
-            if vname not in self.variables:
+            try:
+                constraints.append(self.vnum(vname))
+            except (AssertionError, ValueError, TypeError):
                 raise IOError("Trying to add variables that have not been defined, probably incompatible problem formulation?")
-            constraints.append( self.variables[vname] )
+        self.tag_clauses('from_vnames')
         self.basic_sat_clauses.append(constraints)
 
 
@@ -482,38 +917,27 @@ class polysat:
         sols = [int(v) for v in myinput.readline().strip().split()]
         assert sols[-1] == 0
         sols = sols[:-1]
-        assert len(sols) <= len(self.variables)
+        assert len(sols) <= self.nVars
 
-        for vname, vnum in sorted(self.variables.items()):
-            if vnum > len(sols):
-                break
-            if sols[vnum-1] > 0:
-                output.write(vname+'\n')
+        output.write(self.convert_solution2(sols))
 
     def convert_solution2(self, sols):
-        assert len(sols) <= len(self.variables), "Solution has more variables ({}) than expected ({})".format(len(sols), len(self.variables))
-        out = ""
-
-        for vname, vnum in sorted(self.variables.items()):
-            if vnum > len(sols):
-                break
-            if sols[vnum-1] > 0:
-                out += vname+'\n'
-        return out
+        assert len(sols) <= self.nVars, "Solution has more variables ({}) than expected ({})".format(len(sols), self.nVars)
+        trueVars = [v for v in sols if v > 0]
+        if self.speciesSelectors is not None:
+            # Leave out species that are switched off by their selector
+            unused = set(s for s, v in enumerate(self.speciesSelectors) if sols[v-1] < 0)
+            trueVars = [v for v in trueVars if not (
+                v <= self.offsets['F'] and self.decode(v)[0] in ('C', 'O') and self.decode(v)[1][0] in unused)]
+        return ''.join(self.vname(v)+'\n' for v in trueVars)
 
     def save_named_solution(self,solution,output,B=True,C=True,P=False):
         '''saves text values of system constraints , such as B(2,3) etc'''
+        families = [f for f, keep in (('B', B), ('C', C), ('P', P)) if keep]
         handle = open(output,'w')
-        for vname,vnum in sorted(self.variables.items()):
-            if vnum > len(solution):
-                break
-            if solution[vnum-1] > 0:
-                if 'B' in vname and B:
-                    handle.write('%s\n' % (vname)  )
-                elif 'C' in vname and C:
-                    handle.write('%s\n' % (vname)  )
-                elif 'P' in vname and P:
-                    handle.write('%s\n' % (vname)  )
+        for v in solution:
+            if v > 0 and self.decode(v)[0] in families:
+                handle.write('%s\n' % (self.vname(v))  )
         handle.close()
 
 
@@ -525,14 +949,8 @@ class polysat:
         sols = [int(v) for v in myinput.readline().strip().split()]
         assert sols[-1] == 0
         sols = sols[:-1]
-        assert len(sols) <= len(self.variables)
-        new_constraints = []
-        for vname, vnum in sorted(self.variables.items()):
-            if vnum > len(sols):
-                break
-            if sols[vnum-1] > 0:
-                new_constraints.append(self.variables[vname])
-                #print(vname)
+        assert len(sols) <= self.nVars
+        new_constraints = [v for v in sols if v > 0]
         if append:
             self.additional_sat_clauses.extend(new_constraints)
         return new_constraints
@@ -543,10 +961,10 @@ class polysat:
         lines = [line.strip() for line in myinput.readlines()]
         new_constraints = []
         for vname in lines:
-                new_constraints.append([self.variables[vname]])
-                #print(vname)
+                new_constraints.append([self.vnum(vname)])
         if append:
             #print 'Addding',new_constraints, 'to', self.basic_sat_clauses
+            self.tag_clauses('loaded_solution')
             self.basic_sat_clauses.extend(new_constraints)
             #print self.basic_sat_clauses
         return new_constraints
@@ -557,11 +975,12 @@ class polysat:
         lines = [line.strip() for line in myinput.readlines()]
         new_constraints = []
         for vname in lines:
-            if 'B' in vname or 'C' in vname:
-                new_constraints.append([self.variables[vname]])
-                #print(vname)
+            v = self.vnum(vname)
+            if self.decode(v)[0] in ('B', 'C'):
+                new_constraints.append([v])
         if append:
             #print 'Addding',new_constraints, 'to', self.basic_sat_clauses
+            self.tag_clauses('loaded_solution')
             self.basic_sat_clauses.extend(new_constraints)
             #print self.basic_sat_clauses
         return new_constraints
@@ -570,42 +989,457 @@ class polysat:
     def fill_constraints(self):
         self.generate_constraints()
 
-    def dump_cnf_to_file(self,fname):
-        parameters  = self.output_cnf()
-        with open(fname,'w') as outf:
-            outf.write(parameters)
-
-    def solve(self, timeout=None):
-        formula = CNF(from_string = self.output_cnf())
-        with Glucose4(bootstrap_with=formula.clauses) as m:
-            if timeout:
-                timer = Timer(timeout, interrupt, [m])
-                timer.start()
-                solved = m.solve_limited(expect_interrupt=True)
-                timer.cancel()
-            else:
-                solved = m.solve()
-            if solved == True:
-                return True, self.convert_solution2(m.get_model())
+    def simplify(self):
+        """
+        Unit propagation over basic_sat_clauses, dropping satisfied clauses and
+        removing false literals. Propagated values are kept as unit clauses
+        (first in the formula), so solutions still assign them.
+        """
+        simplified, values, kept = self.basic_sat_clauses.simplified(self.nVars)
+        fixed = np.nonzero(values)[0]
+        self.basic_sat_clauses = ClauseStore(simplified.nLiterals + len(fixed))
+        self.basic_sat_clauses.extend((fixed * values[fixed]).astype(np.int32).reshape(-1, 1))
+        self.basic_sat_clauses.extend(simplified)
+        # Each run of tagged clauses now starts after the units and the kept clauses before it
+        self.clauseTags = [('propagated_units', 0)] + [
+            (family, len(fixed) + int(np.searchsorted(kept, first))) for family, first in self.clauseTags
+        ]
+        # Clause indices have changed, so any live solver has to be rebuilt
+        self.delete_solver()
+
+    def dump_cnf_to_file(self,fname, compression='auto'):
+        """ writes the CNF formula to fname, optionally compressed with 'gzip' or 'xz' """
+        with open_output(fname, compression) as outf:
+            self.output_cnf(outf)
+
+    def variable_table(self):
+        """ returns an int32 array with one row (family index, i, j, k, l) per variable, padded with -1 """
+        table = np.full((self.nVars, 5), -1, dtype=np.int32)
+        for f, family in enumerate(self.families):
+            if family == 'B':
+                indices = np.array(self.B_pairs, dtype=np.int32)
+            elif family == 'D':
+                pairs = np.array(self.D_pairs, dtype=np.int32)
+                pair, o1, o2 = np.indices((len(pairs), self.nO, self.nO)).reshape(3, -1)
+                indices = np.stack([pairs[pair, 0], o1, pairs[pair, 1], o2], axis=1)
+            elif family == 'X':
+                indices = np.arange(self.nAux, dtype=np.int32)[:, None]
             else:
-                return False, None
+                indices = np.indices(self.shapes[family]).reshape(len(self.shapes[family]), -1).T
+            start = self.offsets[family]
+            table[start:start + len(indices), 0] = f
+            table[start:start + len(indices), 1:1 + indices.shape[1]] = indices
+        return table
+
+    def tag_clauses(self, family):
+        """ marks the clauses added to basic_sat_clauses from now on as coming from the named constraint family """
+        if not self.clauseTags or self.clauseTags[-1][0] != family:
+            self.clauseTags.append((family, len(self.basic_sat_clauses)))
+
+    def clause_family_counts(self):
+        """
+        number of clauses per constraint family (see tag_clauses) that added them,
+        such as {'all_particles': 2, 'placement_colors': 10080}, to see which
+        constraints make up the formula
+        """
+        counts = {}
+        ends = [first for _, first in self.clauseTags[1:]] + [len(self.basic_sat_clauses)]
+        for (family, first), end in zip(self.clauseTags, ends):
+            if end > first:
+                counts[family] = counts.get(family, 0) + end - first
+        return counts
+
+    @staticmethod
+    def estimate_size(nL, nBindings, nCubeTypes, nColors, nDim=3, torsionalPatches=True):
+        """
+        number of variables, clauses and literals of the formula for a shape with nL
+        particles and nBindings bindings, as built with the default settings, without
+        building it. Clauses and literals are counted before simplify(), so they are
+        an upper bound on those of the final formula
+        """
+        nS, nC, nP, nO = nCubeTypes, (nColors + 1) * 2, 6, 4
+        nR = len(utils.rotationTable)
+        nEmpty = nL * nP - 2 * nBindings
+        t = 1 if torsionalPatches else 0
+        def exactlyOne(k):
+            # (clauses, literals) of _exactly_one with the pairwise encoding
+            return 1 + k * (k - 1) // 2, k + k * (k - 1)
+        # (number of constraints, (clauses, literals) per constraint)
+        parts = [
+            (nC, exactlyOne(nC)),                   # B
+            (nS * nP, exactlyOne(nC)),              # C
+            (t * nS * nP, exactlyOne(nO)),          # O
+            (nL * nP, exactlyOne(nC)),              # F
+            (t * nL * nP, exactlyOne(nO)),          # A
+            (nBindings * nC * nC, (1, 3)),          # F and B of bindings
+            (t * nBindings * nO * nO, (1, 3)),      # A and D of bindings
+            (t * (nP * (nP - 1)) // 2 * nO * nO, (1, 1)), # fixed D
+            (nL, exactlyOne(nS * nR)),              # P
+            (nL * nS * nR * nP * nC, (2, 6)),       # placement colors
+            (t * nL * nS * nR * nP * nO, (2, 6)),   # placement orientations
+            (nS, (1, nL * nR)),                     # all particles
+            (nC - 2, (1, nS * nP)),                 # all patches
+            (nC * nS * nP, (1, 1)),                 # no color 0
+            (nC + 1 + nColors, (1, 1)),             # color interactions
+            (nEmpty, (1, 1))                        # empty slots
+        ]
+        if nDim == 2:
+            parts.append((nS * (nP + 2), (1, 1)))   # flat orientations
+        elif torsionalPatches:
+            parts.append((nS * nP, (1, 2)))         # blank orientations
+        variables = (nC * (nC + 1)) // 2 + nS * nP * nC + nL * nP * nC + nL * nS * nR
+        if torsionalPatches:
+            variables += nS * nP * nO + nL * nP * nO + (nP * (nP - 1)) // 2 * nO * nO
+        return {
+            'variables': variables,
+            'clauses': sum(n * c for n, (c, _) in parts),
+            'literals': sum(n * l for n, (_, l) in parts)
+        }
+
+    @classmethod
+    def estimate_memory(cls, nL, nBindings, nCubeTypes, nColors, nDim=3, torsionalPatches=True):
+        """ estimated peak RSS in MB of building and solving the formula (see estimate_size) """
+        size = cls.estimate_size(nL, nBindings, nCubeTypes, nColors, nDim, torsionalPatches)
+        return cls.memoryBaseMB + size['literals'] * cls.memoryPerLiteral / (1 << 20)
+
+    @classmethod
+    def encoding_key(cls, **settings):
+        """
+        string naming the encoding built with the given constructor settings (the
+        others at their defaults), for keying stored results. It includes
+        encodingVersion, so results of an older encoding are not reused
+        """
+        parameters = inspect.signature(cls.__init__).parameters
+        settings = {
+            name: settings.get(name, p.default) for name, p in parameters.items()
+            if p.default is not inspect.Parameter.empty and name not in ('nDim', 'torsionalPatches')
+        }
+        return 'polysat v{} {}'.format(cls.encodingVersion, json.dumps(settings, sort_keys=True))
+
+    def save_variable_map(self, fname):
+        """ saves the variable numbering as a binary .npz file, to be read with load_variable_map """
+        with open(fname, 'wb') as f:
+            np.savez_compressed(f, families=np.array(self.families), table=self.variable_table())
+
+    def get_solver(self):
+        """
+        returns the live solver, creating it on first use. Clauses added to
+        basic_sat_clauses since the last call (such as those from forbidSolution)
+        are passed on to it, so that what it has learned so far is kept.
+        """
+        if self.solver is None:
+            self.solver = Glucose4()
+            self.nSolverClauses = 0
+        # Clauses are fed straight from the clause store, without a DIMACS round-trip
+        self.solver.append_formula(self.basic_sat_clauses.iter_from(self.nSolverClauses))
+        self.nSolverClauses = len(self.basic_sat_clauses)
+        return self.solver
+
+    def delete_solver(self):
+        """ frees the live solver, the next solve() starts from scratch """
+        if self.solver is not None:
+            self.solver.delete()
+            self.solver = None
+
+    def solve(self, timeout=None, assumptions=[]):
+        m = self.get_solver()
+        if timeout:
+            timer = Timer(timeout, interrupt, [m])
+            timer.start()
+            solved = m.solve_limited(assumptions=assumptions, expect_interrupt=True)
+            timer.cancel()
+            m.clear_interrupt()
+        else:
+            solved = m.solve(assumptions=assumptions)
+        if solved == True:
+            return True, self.convert_solution2(m.get_model())
+        elif solved is None:
+            # Interrupted before an answer was found
+            return 'TIMEOUT', None
+        else:
+            return False, None
+
+    def add_selectors(self):
+        """
+        Adds a selector literal per species and per color pair (colors 2 and up).
+        A species with a false selector is empty and placed nowhere, a color
+        pair with a false selector is not used by any patch.
+        Selectors are only ever switched on as a prefix (the first n species
+        or color pairs), so a selector implies the one before it.
+        """
+        self.speciesSelectors = [self.new_var() for _ in range(self.nS)]
+        self.colorSelectors = [self.new_var() for _ in range(2, self.nC, 2)]
+        self.tag_clauses('selectors')
+        for selectors in (self.speciesSelectors, self.colorSelectors):
+            for prev, selector in zip(selectors, selectors[1:]):
+                self.basic_sat_clauses.append((-selector, prev))
+        for s, selector in enumerate(self.speciesSelectors):
+            for p in range(self.nP):
+                self.basic_sat_clauses.append((selector, self.C(s, p, 1)))
+                if self.torsionalPatches:
+                    self.basic_sat_clauses.append((selector, self.O(s, p, utils.getFlatFaceRot()[p] if self.nD == 2 else 0)))
+            for l in range(self.nL):
+                for r in range(self.nR):
+                    self.basic_sat_clauses.append((selector, -self.P(l, s, r)))
+        for c in range(2, self.nC):
+            for s in range(self.nS):
+                for p in range(self.nP):
+                    self.basic_sat_clauses.append((self.colorSelectors[(c-2)//2], -self.C(s, p, c)))
+
+    def species_guard(self, s):
+        """ literals to add to a clause that should only hold if species s is used """
+        return [] if self.speciesSelectors is None else [-self.speciesSelectors[s]]
+
+    def color_guard(self, c):
+        """ literals to add to a clause that should only hold if color c is used """
+        return [] if self.colorSelectors is None or c < 2 else [-self.colorSelectors[(c-2)//2]]
+
+    def assumptions_for(self, nCubeTypes, nColors):
+        """ selector assumptions for solving with only the first nCubeTypes species and nColors color pairs """
+        assert self.speciesSelectors is not None, "Needs selectors=True"
+        assert 0 < nCubeTypes <= len(self.speciesSelectors)
+        assert 0 < nColors <= len(self.colorSelectors)
+        return [v if s < nCubeTypes else -v for s, v in enumerate(self.speciesSelectors)] + \
+               [v if k < nColors else -v for k, v in enumerate(self.colorSelectors)]
+
+    def unsat_core(self):
+        """ after an unsatisfiable solve with assumptions, returns the set of assumptions that caused it """
+        return set(self.solver.get_core() or [])
+
+    def failed_bounds(self):
+        """ after an unsatisfiable solve with assumptions, returns which of 'nCubeTypes' and 'nColors' are in the core
+        as upper bounds. Only switched off selectors bound the count, the ones switched on only fix it from below """
+        core = set(-v for v in self.unsat_core() if v < 0)
+        bounds = []
+        if core & set(self.speciesSelectors):
+            bounds.append('nCubeTypes')
+        if core & set(self.colorSelectors):
+            bounds.append('nColors')
+        return bounds
+
+    def selector_counts(self, model):
+        """ number of species and color pairs switched on in model """
+        return (sum(model[v-1] > 0 for v in self.speciesSelectors),
+                sum(model[v-1] > 0 for v in self.colorSelectors))
+
+    def cost_bound_clauses(self, maxCost, weights=(1, 1)):
+        """
+        clauses allowing only selector counts with
+        weights[0]*nCubeTypes + weights[1]*nColors <= maxCost.
+        As selectors are a prefix, this is one clause per number of species.
+        """
+        speciesWeight, colorWeight = weights
+        clauses = []
+        for nCubeTypes in range(1, len(self.speciesSelectors) + 1):
+            # Most color pairs affordable with nCubeTypes species
+            nColors = (maxCost - speciesWeight*nCubeTypes) // colorWeight
+            if nColors < 0:
+                clauses.append([-self.speciesSelectors[nCubeTypes-1]])
+            elif nColors < len(self.colorSelectors):
+                clauses.append([-self.speciesSelectors[nCubeTypes-1], -self.colorSelectors[nColors]])
+        return clauses
+
+    def minimize_rule(self, weights=(1, 1), method='cardinality', timeout=None, assumptions=[]):
+        """
+        Finds a rule minimising weights[0]*nCubeTypes + weights[1]*nColors in
+        this single encoding (needs selectors=True), with at least one species
+        and color pair. With method 'cardinality', the live solver is solved
+        under ever tighter bounds on the selector counts until it is
+        unsatisfiable; with method 'rc2', the selectors are soft clauses of a
+        MaxSAT problem solved by RC2. The timeout (seconds) only applies to
+        'cardinality'.
+        Returns (True, solution, (nCubeTypes, nColors)) for a proven optimum,
+        (False, None, None) if there is no rule within the encoded maxima and
+        ('TIMEOUT', solution, (nCubeTypes, nColors)) with the best rule so far
+        (or None) if it ran out of time.
+        """
+        assert self.speciesSelectors is not None, "Needs selectors=True"
+        assumptions = list(assumptions) + [self.speciesSelectors[0], self.colorSelectors[0]]
+        if method == 'rc2':
+            wcnf = WCNF()
+            wcnf.extend(self.basic_sat_clauses)
+            for v in assumptions:
+                wcnf.append([v])
+            for selectors, weight in zip((self.speciesSelectors, self.colorSelectors), weights):
+                for v in selectors:
+                    wcnf.append([-v], weight=weight)
+            with RC2(wcnf) as rc2:
+                model = rc2.compute()
+            if model is None:
+                return False, None, None
+            return True, self.convert_solution2(model), self.selector_counts(model)
+        elif method != 'cardinality':
+            raise ValueError("Unknown method '{}', expected 'cardinality' or 'rc2'".format(method))
+
+        # Bounds are only added under an activation literal, retired when done
+        start = time.time()
+        act = self.new_var()
+        best = None
+        try:
+            while True:
+                remaining = None
+                if timeout is not None:
+                    remaining = timeout - (time.time() - start)
+                    if remaining <= 0:
+                        return ('TIMEOUT',) + (best or (None, None))
+                result, solution = self.solve(remaining, assumptions + [act])
+                if result == 'TIMEOUT':
+                    return ('TIMEOUT',) + (best or (None, None))
+                elif not result:
+                    break
+                counts = self.selector_counts(self.solver.get_model())
+                best = (solution, counts)
+                maxCost = weights[0]*counts[0] + weights[1]*counts[1] - 1
+                for clause in self.cost_bound_clauses(maxCost, weights):
+                    self.solver.add_clause([-act] + clause)
+        finally:
+            if self.solver is not None:
+                self.solver.add_clause([-act])
+        if best is None:
+            return False, None, None
+        return (True,) + best
+
+    def enumerate_solutions(self, maxSolutions=None, timeout=None, assumptions=[]):
+        """
+        Generator over solutions (in the format of convert_solution2, B, C and O
+        variables only) that differ in their B, C and O variables, i.e. in the
+        rule. Solutions that only differ in placement (P, F, A) are skipped.
+        Found rules are blocked in the live solver under a fresh activation
+        literal, which is switched off again when the generator is closed, so
+        the solver can be used afterwards. Sets self.timedOut if the timeout
+        (in seconds, for the whole enumeration) runs out.
+        """
+        self.timedOut = False
+        start = time.time()
+        act = self.new_var()
+        nFound = 0
+        try:
+            while maxSolutions is None or nFound < maxSolutions:
+                remaining = None
+                if timeout is not None:
+                    remaining = timeout - (time.time() - start)
+                    if remaining <= 0:
+                        self.timedOut = True
+                        break
+                result, solution = self.solve(remaining, assumptions + [act])
+                if result == 'TIMEOUT':
+                    self.timedOut = True
+                    break
+                elif not result:
+                    break
+                nFound += 1
+                # B, C and O vars are first, so blocking their true values blocks the rule
+                model = self.solver.get_model()
+                self.solver.add_clause([-act] + [-v for v in range(1, self.BCO_varlen + 1) if model[v-1] > 0])
+                yield ''.join(line for line in solution.splitlines(True) if line[0] in 'BCO')
+        finally:
+            if self.solver is not None:
+                self.solver.add_clause([-act])
+
+    @classmethod
+    def default_portfolio(cls):
+        """ the (solver, seed) pairs solve_portfolio races by default, at most one per CPU """
+        return cls.portfolio[:max(1, os.cpu_count() or 1)]
+
+    def solve_portfolio(self, timeout=None, assumptions=[], portfolio=None):
+        """
+        Races several pysat backends, and random clause orders given by the
+        seeds, in worker processes. The first answer is used and the other
+        workers are terminated, also when this process is terminated while
+        they race. Returns the same as solve(), or 'ERROR' if every worker
+        failed without an answer, while the outcome and time of each backend
+        is saved in self.portfolioStats. Daemonic processes (such as those of
+        a multiprocessing.Pool) cannot start workers, so there it falls back
+        to solve()
+        """
+        if portfolio is None:
+            portfolio = self.default_portfolio()
+        start = time.time()
+        if multiprocessing.current_process().daemon:
+            result = self.solve(timeout, assumptions)
+            self.portfolioStats = [{'solver': 'glucose4', 'seed': 0, 'result': result[0], 'time': time.time() - start}]
+            return result
+
+        results = multiprocessing.Queue()
+        workers = {}
+        previousHandler = None
+        if threading.current_thread() is threading.main_thread():
+            # Terminating this process has to go through the finally block below,
+            # or the workers would keep running
+            previousHandler = signal.signal(signal.SIGTERM, exit_on_signal)
+        self.portfolioStats = []
+        answer = None
+        timedOut = False
+        try:
+            for name, seed in portfolio:
+                w = multiprocessing.Process(target=portfolio_worker, args=(name, seed, self.basic_sat_clauses, assumptions, results))
+                w.start()
+                workers[(name, seed)] = w
+            while answer is None and len(self.portfolioStats) < len(workers):
+                finished = set((s['solver'], s['seed']) for s in self.portfolioStats)
+                # Checked before waiting, so that the answer of a worker that
+                # has just exited is still read from the queue
+                alive = any(w.is_alive() for key, w in workers.items() if key not in finished)
+                wait = self.portfolioPollSeconds if alive else 0
+                if timeout is not None:
+                    remaining = timeout - (time.time() - start)
+                    if remaining <= 0:
+                        timedOut = True
+                        break
+                    wait = min(wait, remaining)
+                try:
+                    name, seed, solved, model, seconds = results.get(timeout=wait)
+                except queue.Empty:
+                    if not alive:
+                        # The others exited without an answer, such as when killed for memory
+                        break
+                    continue
+                self.portfolioStats.append({'solver': name, 'seed': seed, 'result': solved, 'time': seconds})
+                if solved in (True, False):
+                    answer = (solved, model)
+        finally:
+            finished = set((s['solver'], s['seed']) for s in self.portfolioStats)
+            for key, w in workers.items():
+                if key in finished:
+                    continue
+                if w.is_alive():
+                    w.terminate()
+                    outcome = 'KILLED'
+                else:
+                    outcome = 'EXITED ({})'.format(w.exitcode)
+                self.portfolioStats.append({'solver': key[0], 'seed': key[1], 'result': outcome, 'time': time.time() - start})
+            for w in workers.values():
+                w.join()
+            if previousHandler is not None:
+                signal.signal(signal.SIGTERM, previousHandler)
+
+        if answer is None:
+            return ('TIMEOUT' if timedOut else 'ERROR'), None
+        solved, model = answer
+        if solved:
+            return True, self.convert_solution2(model)
+        return False, None
 
     def add_constraints_no_empty_species(self):
+        self.tag_clauses('no_empty_species')
         for s in range(self.nS):
-            self.basic_sat_clauses.append([self.C(s, 0, c) for c in range(2, self.nC)])
+            self.basic_sat_clauses.append(self.species_guard(s) + [self.C(s, 0, c) for c in range(2, self.nC)])
 
     def add_constraints_all_particles(self):
+        self.tag_clauses('all_particles')
         for s in range(self.nS):
-            self.basic_sat_clauses.append([self.P(l,s,r) for l in range(self.nL) for r in range(self.nR)])
+            self.basic_sat_clauses.append(self.species_guard(s) + [self.P(l,s,r) for l in range(self.nL) for r in range(self.nR)])
 
     def add_constraints_all_patches(self):
+        self.tag_clauses('all_patches')
         for c in range(self.nC):
-            self.basic_sat_clauses.append([self.C(s,p,c) for s in range(self.nS) for p in range(self.nP)])
+            self.basic_sat_clauses.append(self.color_guard(c) + [self.C(s,p,c) for s in range(self.nS) for p in range(self.nP)])
 
     def add_constraints_all_patches_except(self, forbidden, nonRequired):
+        self.tag_clauses('all_patches')
         for c in range(self.nC):
             if c not in forbidden and c not in nonRequired:
-                self.basic_sat_clauses.append([self.C(s, p, c) for s in range(self.nS) for p in range(self.nP)])
+                self.basic_sat_clauses.append(self.color_guard(c) + [self.C(s, p, c) for s in range(self.nS) for p in range(self.nP)])
             # Do not use forbidden color
             for p in range(self.nP):
                 for s in range(self.nS):
@@ -615,6 +1449,7 @@ class polysat:
                         )
 
     def add_constraints_fixed_blank_orientation(self):
+        self.tag_clauses('fixed_blank_orientation')
         for p in range(self.nP):
             for s in range(self.nS):
                 self.basic_sat_clauses.append((
@@ -623,24 +1458,155 @@ class polysat:
                 ))
 
 
+    def _lex_leq(self, xs, ys, guard=[]):
+        """ returns a list of constraints implementing xs <=lex ys for two literal sequences, with false < true """
+        constraints = []
+        e = None # True if all previous literal pairs are equal (None if there are none)
+        for i, (x, y) in enumerate(zip(xs, ys)):
+            prefix = guard + ([] if e is None else [-e])
+            # If all previous literals were equal, x must not be larger than y
+            constraints.append(tuple(prefix + [-x, y]))
+            if i < len(xs) - 1:
+                eNext = self.new_var()
+                constraints.append(tuple(prefix + [-x, -y, eNext]))
+                constraints.append(tuple(prefix + [x, y, eNext]))
+                e = eNext
+        return constraints
+
+    def add_constraints_lex_leader(self, perm, guard=[]):
+        """
+        Adds x <=lex perm(x), where perm is a symmetry of the problem given as a
+        dictionary mapping variable numbers (unmapped variables are fixed).
+        Variables are compared in variable number order, so perm must include
+        every variable it moves below its highest key. Each constraint then
+        compares a prefix of the same order, which keeps them sound together.
+        """
+        xs, ys = [], []
+        for v in sorted(perm):
+            w = perm[v]
+            if w == v:
+                continue
+            if w < v and perm.get(w) == v:
+                # Second half of a swap, equal if the first half was
+                continue
+            xs.append(v)
+            ys.append(w)
+        self.basic_sat_clauses.extend(self._lex_leq(xs, ys, guard))
+
+    def add_constraints_species_symmetry(self):
+        """ orders species lexicographically by their patch colors and orientations, by swapping neighbouring species """
+        self.tag_clauses('species_symmetry')
+        for s in range(self.nS - 1):
+            perm = {}
+            for p in range(self.nP):
+                for c in range(self.nC):
+                    perm[self.C(s, p, c)] = self.C(s+1, p, c)
+                    perm[self.C(s+1, p, c)] = self.C(s, p, c)
+                if self.torsionalPatches:
+                    for o in range(self.nO):
+                        perm[self.O(s, p, o)] = self.O(s+1, p, o)
+                        perm[self.O(s+1, p, o)] = self.O(s, p, o)
+            # Only applies if both species are used
+            self.add_constraints_lex_leader(perm, self.species_guard(s+1))
+
+    def _color_perm(self, colorMap):
+        """ maps B and C variables according to a permutation of colors, given as a dictionary """
+        perm = {}
+        for c1, c2 in self.B_pairs:
+            perm[self.B(c1, c2)] = self.B(colorMap.get(c1, c1), colorMap.get(c2, c2))
+        for s in range(self.nS):
+            for p in range(self.nP):
+                for c in range(self.nC):
+                    perm[self.C(s, p, c)] = self.C(s, p, colorMap.get(c, c))
+        return perm
+
+    def add_constraints_color_symmetry(self):
+        """ breaks swapping the two colors of a pair, and swapping neighbouring color pairs (colors 0 and 1 are fixed) """
+        self.tag_clauses('color_symmetry')
+        for c in range(2, self.nC-1, 2):
+            self.add_constraints_lex_leader(self._color_perm({c: c+1, c+1: c}), self.color_guard(c))
+            if c + 3 < self.nC:
+                self.add_constraints_lex_leader(self._color_perm({c: c+2, c+1: c+3, c+2: c, c+3: c+1}), self.color_guard(c+2))
+
+    def rotation_matrix(self, r):
+        """ matrix rotating the patch directions of utils.getRuleOrder() the same way as rotation r """
+        ruleOrder = utils.getRuleOrder()
+        # Columns are where the x, y and z axes (patches 1, 3 and 5) end up
+        return np.array([ruleOrder[self.rotation(p, r)] for p in (1, 3, 5)]).T
+
+    def shape_automorphisms(self):
+        """
+        returns the rotations of a single connected shape that map it onto itself,
+        as a list of (rotation, position map) tuples, excluding the identity
+        """
+        top = [(l1, p1, l2, p2) for (l1, p1), (l2, p2) in self.bindings.items()]
+        coordMaps = utils.calcCoordmapFromTop(top)
+        if len(coordMaps) != 1:
+            # Only consider shapes made of a single component
+            return []
+        ids = list(coordMaps[0].keys())
+        coords = np.array([coordMaps[0][l] for l in ids])
+        lookup = {tuple(x): l for l, x in zip(ids, coords.round().astype(int).tolist())}
+        bindings = set(top) | set((l2, p2, l1, p1) for l1, p1, l2, p2 in top)
+        automorphisms = []
+        for r in range(1, self.nR):
+            rotated = coords @ self.rotation_matrix(r).T
+            # Translate so that the rotated shape has the same minimum corner
+            rotated += coords.min(axis=0) - rotated.min(axis=0)
+            lmap = {}
+            for l, x in zip(ids, rotated.round().astype(int).tolist()):
+                if tuple(x) not in lookup:
+                    break
+                lmap[l] = lookup[tuple(x)]
+            else:
+                # Bindings also need to be preserved, not just positions
+                if all((lmap[l1], self.rotation(p1, r), lmap[l2], self.rotation(p2, r)) in bindings
+                        for l1, p1, l2, p2 in top):
+                    automorphisms.append((r, lmap))
+        return automorphisms
+
+    def add_constraints_shape_symmetry(self):
+        """ breaks rotations of the target shape onto itself, by how they move position patch colors and orientations """
+        self.tag_clauses('shape_symmetry')
+        for r, lmap in self.shape_automorphisms():
+            perm = {}
+            for l, lRot in lmap.items():
+                for p in range(self.nP):
+                    pRot = self.rotation(p, r)
+                    for c in range(self.nC):
+                        perm[self.F(l, p, c)] = self.F(lRot, pRot, c)
+                    if self.torsionalPatches:
+                        for o in range(self.nO):
+                            perm[self.A(l, p, o)] = self.A(lRot, pRot, self.orientation(p, r, o))
+            self.add_constraints_lex_leader(perm)
+
     def add_constraints_no_self_complementarity(self,above_color=0):
+        self.tag_clauses('no_self_complementarity')
         for c in range(above_color,self.nC):
             self.basic_sat_clauses.append([-self.B(c,c)])
 
     def fix_particle_colors(self,ptype,sid,cid):
+        self.tag_clauses('fixed_particle_colors')
         self.basic_sat_clauses.append([self.C(ptype,sid,cid)])
 
     def fix_slot_colors(self,ptype,sid,cid):
+        self.tag_clauses('fixed_slot_colors')
         self.basic_sat_clauses.append([self.F(ptype,sid,cid)])
 
     def fix_color_interaction(self,c1,c2):
+        self.tag_clauses('fixed_color_interactions')
         self.basic_sat_clauses.append([self.B(c1,c2)])
 
-    def forbidSolution(self, solution):
-        forbidden = []
+    def forbidSolution(self, solution, assumptions=[]):
+        """ blocks the species colors and orientations of solution, only under the given assumptions if any """
+        forbidden = [-v for v in assumptions]
         for vname in solution.split('\n'):
-            if 'C' in vname or 'O' in vname:
-                forbidden.append(-self.variables[vname])
+            if vname.strip() == '':
+                continue
+            v = self.vnum(vname)
+            if self.decode(v)[0] in ('C', 'O'):
+                forbidden.append(-v)
+        self.tag_clauses('forbidden_solutions')
         self.basic_sat_clauses.append(forbidden)
 
     def run_relsat(self,nSolutions, timeout=18000):
@@ -676,10 +1642,7 @@ class polysat:
                 if 'Solution' in line:
                     myvars = line.strip().split(':')[1].strip()
                     varnames =  self.load_solution_from_lines([myvars+ ' 0'])
-                    clean_sol  = []
-                    for x in varnames:
-                        if 'B(' in x or 'C(' in x or 'O(' in x:
-                            clean_sol.append(x)
+                    clean_sol  = [x for x in varnames if x[0] in ('B', 'C', 'O')]
                     all_solutions.append(clean_sol)
 
             return len(out)-1, all_solutions
@@ -2,9 +2,8 @@ import utils
 import json
 from polycubeSolver import polysat
 import random
-import pickle
 
-def sampleClauses(solveSpecPath, nSamples=5, preview=False, outdir='../../../'):
+def sampleClauses(solveSpecPath, nSamples=5, preview=False, outdir='../../../', compression=None):
     name = solveSpecPath.split('/')[-1].split('.')[0]
 
     with open(solveSpecPath, 'r') as f:
@@ -20,6 +19,9 @@ def sampleClauses(solveSpecPath, nSamples=5, preview=False, outdir='../../../'):
         outPath = outdir+'{}t_{}c_{}_noAllnoEmpty.cnf'.format(
             nCubeTypes, nColors, name
         )
+        varPath = outPath+'.variables.npz'
+        if compression is not None:
+            outPath += {'gzip': '.gz', 'xz': '.xz'}[compression]
         if not preview:
             mysat = polysat(
                 solveSpec['bindings'],
@@ -32,10 +34,8 @@ def sampleClauses(solveSpecPath, nSamples=5, preview=False, outdir='../../../'):
                 forbidEmptySpecies = True
             )
             
-            mysat.dump_cnf_to_file(outPath)
-
-            with open(outPath+'.variables.pickle','wb') as f:
-                pickle.dump(mysat.variables, f)
+            mysat.dump_cnf_to_file(outPath, compression)
+            mysat.save_variable_map(varPath)
                                    
         print('Saved to {}'.format(outPath))
 
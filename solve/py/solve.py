@@ -15,6 +15,12 @@ import multiprocessing
 import json
 import traceback
 import os
+import threading
+import functools
+import time
+import concurrent.futures
+import solveCache
+from telemetry import JobTelemetry
 
 def readSolution(sol):
     colorCounter = 1
@@ -57,7 +63,7 @@ def readSolutionFromPath(path):
     #os.remove(path)
     return readSolution(sol)
 
-def find_solution(top, nCubeTypes, nColors, nSolutions=1, nDim=3, torsionalPatches=True):
+def find_solution(top, nCubeTypes, nColors, nSolutions=1, nDim=3, torsionalPatches=True, portfolio=False, stats=None, telemetry=None, returnPolysat=False):
     """Find a polycube rule that assembles the given topology
 
     Args:
@@ -65,32 +71,43 @@ def find_solution(top, nCubeTypes, nColors, nSolutions=1, nDim=3, torsionalPatch
         nCubeTypes (int): Number of different building block cubes (species)
         nColors (int): Number of colors (not counting negative)
         uniquePatches (bool, optional): Set to true if you want to ensure determinism, but also limit modularity. Defaults to False.
+        portfolio (bool, optional): Race several SAT solvers for single solutions (see polysat.solve_portfolio). Defaults to False.
+        stats (dict, optional): If given, per-solver outcomes and timings are saved to stats['portfolio'].
+        telemetry (JobTelemetry, optional): If given, encoding and solver time are added to it.
+        returnPolysat (bool, optional): Also return the polysat instance, with the rules found forbidden, so that more can be found with it. Defaults to False.
 
     Returns:
-        [dict]: Returns a polycube rule dict.
+        [dict]: Returns a polycube rule dict, or 'TIMEOUT', or 'ERROR' if all portfolio solvers failed.
+        With returnPolysat, a tuple of that and the polysat instance.
     """
+    telemetry = telemetry or JobTelemetry(path=None)
 
-    mysat = polysat(top, nCubeTypes, nColors, nDim, torsionalPatches)
+    with telemetry.timed('encodingSeconds'):
+        mysat = polysat(top, nCubeTypes, nColors, nDim, torsionalPatches)
+    telemetry.encoded(mysat)
 
     if nSolutions == 1: # Use minisat for single solutions
-        result, solution = mysat.solve()
-        if result == 'TIMEOUT':
-            return result
-        elif result:
-            return [readSolution(solution)]
-        else:
-            return []
+        with telemetry.timed('solverSeconds'):
+            if portfolio:
+                result, solution = mysat.solve_portfolio()
+                if stats is not None:
+                    stats['portfolio'] = mysat.portfolioStats
+            else:
+                result, solution = mysat.solve()
+        solutions = [solution] if result == True else []
+        results = result if result in ('TIMEOUT', 'ERROR') else [readSolution(sol) for sol in solutions]
     else:
         timeout = 86400 # 24h in seconds
-        result = mysat.run_relsat(nSolutions=nSolutions, timeout=timeout)
-        if result == "TIMEOUT":
-            return result
-        nResults, results = result
-        if nResults > 0:
-            #print("{} solutions found".format(nResults))
-            return [readSolution("/n".join(sol)) for sol in results]
-        else:
-            return []
+        with telemetry.timed('solverSeconds'):
+            solutions = list(mysat.enumerate_solutions(nSolutions, timeout))
+        results = [readSolution(sol) for sol in solutions]
+        if mysat.timedOut and len(results) == 0:
+            results = 'TIMEOUT'
+    if returnPolysat:
+        for sol in solutions:
+            mysat.forbidSolution(sol)
+        return results, mysat
+    return results
 
 def smartEnumerate(xMax, yMax):
     return sorted(
@@ -101,89 +118,152 @@ def smartEnumerate(xMax, yMax):
 def patchCount(cube):
     return len([face for face in cube if face['color'] != 0])
 
-def findRuleFor(top, nCubeTypes, nColors, nSolutions, nDim=3, torsionalPatches=True):
+def formatPortfolioStats(stats):
+    return ', '.join('{} (seed {}): {} after {:.2f}s'.format(
+        s['solver'], s['seed'], s['result'], s['time']) for s in stats if 'time' in s)
+
+def ruleStatus(rule):
+    """ 'SAT', 'UNSAT', 'UND', 'TIMEOUT' or 'ERROR' for a findRuleFor result """
+    if rule is None:
+        return 'UNSAT'
+    return rule if rule in ('UND', 'TIMEOUT', 'ERROR') else 'SAT'
+
+def findRuleFor(top, nCubeTypes, nColors, nSolutions, nDim=3, torsionalPatches=True, portfolio=False, cachePath='auto', telemetryPath='auto'):
+    """Same as solveRuleFor, but checks the solve cache (see solveCache.openCache) first,
+    and stores new results in it. A telemetry record of the job is written to
+    telemetryPath (see telemetry.JobTelemetry).
+    """
+    method = 'findRuleFor(nSolutions={}), {}'.format(nSolutions, polysat.encoding_key())
+    telemetry = JobTelemetry(
+        telemetryPath, topology=solveCache.topologyHash(top), nCubeTypes=nCubeTypes,
+        nColors=nColors, nDim=nDim, torsion=torsionalPatches, method=method
+    )
+    cache = solveCache.openCache(cachePath)
+    if cache is not None:
+        cached = cache.get(top, nDim, torsionalPatches, nCubeTypes, nColors, method)
+        if cached is not None:
+            status, rule = cached
+            log = '\n{} colors and {} cube types: {} (cached)\n'.format(nColors, nCubeTypes, status)
+            cache.close()
+            telemetry.finish(status=status, result=rule, cached=True)
+            return ("{},{}".format(nCubeTypes,nColors), rule, log)
+    start = time.time()
+    i, rule, log = solveRuleFor(top, nCubeTypes, nColors, nSolutions, nDim, torsionalPatches, portfolio, telemetry)
+    status = ruleStatus(rule)
+    telemetry.finish(status=status, result=rule, cached=False)
+    if cache is not None:
+        if rule != 'ERROR':
+            cache.put(
+                top, nDim, torsionalPatches, nCubeTypes, nColors, method,
+                status, rule if status == 'SAT' else None, rule, time.time() - start
+            )
+        cache.close()
+    return (i, rule, log)
+
+def solveRuleFor(top, nCubeTypes, nColors, nSolutions, nDim=3, torsionalPatches=True, portfolio=False, telemetry=None):
     i = "{},{}".format(nCubeTypes,nColors)
     log = '\n{} colors and {} cube types: '.format(nColors, nCubeTypes)
+    stats = {}
+    telemetry = telemetry or JobTelemetry(path=None)
     try:
-        rules = find_solution(top, nCubeTypes, nColors, nDim=nDim, torsionalPatches=torsionalPatches)
+        rules, mysat = find_solution(
+            top, nCubeTypes, nColors, nDim=nDim, torsionalPatches=torsionalPatches,
+            portfolio=portfolio, stats=stats, telemetry=telemetry, returnPolysat=True
+        )
     except Exception as error:
         log +="Error in find_solution: {}\n\t{}".format(error, traceback.format_exc())
         return (i, 'ERROR', log)
+    if 'portfolio' in stats:
+        log += '\n  Portfolio: {}\n'.format(formatPortfolioStats(stats['portfolio']))
 
     if rules == 'TIMEOUT':
         log += "Timed out!"
         return (i, rules, log)
+    if rules == 'ERROR':
+        log += "All portfolio solvers failed"
+        return (i, rules, log)
     if len(rules) > 0:
         rule = sorted(rules[0], key=patchCount, reverse=True)
         decRule = utils.ruleToDec(rule)
-        if libpolycubes.isBoundedAndDeterministic(decRule, isHexString=False):
+        telemetry.count('candidates')
+        with telemetry.timed('validationSeconds'):
+            valid = libpolycubes.isBoundedAndDeterministic(decRule, isHexString=False)
+        if valid:
             return (i, decRule, log)
         else:
             log += '{} is UND\n'.format(decRule)
+            # Go through alternative rules as they are found, stopping at the first valid one.
+            # They are found with the same solver, on which the first rule is already forbidden
+            altrules = set()
             try:
-                sols = find_solution(
-                    top, nCubeTypes, nColors, nSolutions=nSolutions, nDim=nDim,
-                    torsionalPatches=torsionalPatches
-                )
+                solutions = mysat.enumerate_solutions(nSolutions, timeout=86400)
+                while True:
+                    with telemetry.timed('solverSeconds'):
+                        sol = next(solutions, None)
+                    if sol is None:
+                        break
+                    altrule = utils.ruleToDec(sorted(readSolution(sol), key=patchCount, reverse=True))
+                    if altrule == decRule or altrule in altrules:
+                        continue
+                    altrules.add(altrule)
+                    telemetry.count('candidates')
+                    with telemetry.timed('validationSeconds'):
+                        valid = libpolycubes.isBoundedAndDeterministic(altrule, isHexString=False)
+                    if valid:
+                        log += '  {} is a valid solution\n'.format(altrule)
+                        return (i, altrule, log)
+                    else:
+                        log += '  {} is UND\n'.format(altrule)
             except Exception as error:
                 log +="Error in find_solution: {}\n\t{}".format(error, traceback.format_exc())
                 return (i, 'ERROR', log)
 
-            if sols == 'TIMEOUT':
-                return (i, sols, log)
-            altrules = set(utils.ruleToDec(sorted(r, key=patchCount)) for r in sols)
-            log += '  Trying {} alternative solutions\n'.format(len(altrules))
-            for altrule in altrules:
-                if libpolycubes.isBoundedAndDeterministic(altrule, isHexString=False):
-                    log += '  {} is a valid solution\n'.format(altrule)
-                    return (i, altrule, log)
-                else:
-                    log += '  {} is UND\n'.format(altrule)
+            log += '  Tried {} alternative solutions\n'.format(len(altrules))
+            if mysat.timedOut:
+                return (i, 'TIMEOUT', log)
             log += '  All UND'
             return (i, 'UND', log)
     else:
         log += 'Sorry, no solution'
     return (i, None, log)
 
-results = {}
-finalResult = None
-ongoing = 0
-def log_result(result):
-    global ongoing
-    ongoing -= 1
-    i, rule, log = result
-    global results
-    global finalResult
-    results[i] = rule
-    if rule and rule != 'UND' and rule != 'TIMEOUT' and rule != 'ERROR':
-        polyurl = "https://akodiat.github.io/polycubes?decRule={}"
-        log += 'Found solution: '+polyurl.format(rule)
-    print(log, flush=True)
-
-    nCubeTypes, nColors = [int(e) for e in i.split(',')]
-    # Check if all simpler solutions have been ruled out
-    for inT, inC in smartEnumerate(nCubeTypes, nColors):
-        key = "{},{}".format(inT,inC)
-        if not key in results or finalResult:
-            # Break if we either have no answer for this level
-            # or we already have the solution there
-            break
-        r = results[key]
-        if r and r != 'UND' and r != 'TIMEOUT' and r != 'ERROR':
-            # Lower levels have been ruled out and
-            # we have our final result
-            print('Finished!', flush = True)
-            finalResult = r
-            break
-
-    # Pretty print status
+def probeRuleBound(top, nCubeTypes, nColors, nDim=3, torsionalPatches=True, timeout=600):
+    """Check if there is any rule with at most nCubeTypes species and nColors
+    colors, by solving without requiring all species and colors to be used.
+    Unlike the exact problem, this is monotone: if there is no such rule,
+    there is none with fewer species or colors either.
+
+    Args:
+        timeout (int, optional): Seconds to solve for, as the probe is only worth it if it is quick. Defaults to 600.
+
+    Returns:
+        tuple: ("nCubeTypes,nColors", True, False or 'TIMEOUT')
+    """
+    i = "{},{}".format(nCubeTypes,nColors)
+    mysat = polysat(top, nCubeTypes, nColors, nDim, torsionalPatches, allParticles=False, allPatches=False)
+    result, _ = mysat.solve(timeout)
+    return (i, result)
+
+def formatPoints(keys):
+    return ', '.join('{} colors and {} cube types'.format(nColors, nCubeTypes) for nCubeTypes, nColors in keys)
+
+def isValidRule(rule):
+    return rule and rule not in ('UND', 'TIMEOUT', 'ERROR', 'MEM')
+
+def printResultGrid(results, current):
+    """Pretty print the result for each (nCubeTypes, nColors) tried so far
+
+    Args:
+        results (dict): Rule (or 'UND', 'TIMEOUT', 'ERROR', 'MEM', None) per (nCubeTypes, nColors)
+        current (tuple): (nCubeTypes, nColors) to highlight
+    """
     OKBLUE = '\033[94m'
     OKGREEN = '\033[92m'
     FAIL = '\033[91m'
     ENDC = '\033[0m'
     BOLD = '\033[1m'
-    nTs = max(int(k.split(',')[0]) for k in results.keys())
-    nCs = max(int(k.split(',')[1]) for k in results.keys())
+    nTs = max(k[0] for k in results.keys())
+    nCs = max(k[1] for k in results.keys())
     for nt in range(0,nTs+1):
         for nc in range(0,nCs+1):
             if nt==0 and nc!=0:
@@ -191,48 +271,437 @@ def log_result(result):
             elif nc==0 and nt!=0:
                 print("nT={}".format(nt), end='\t', flush=True)
             elif nc>0 and nt>0:
-                key = '{},{}'.format(nt,nc)
+                key = (nt,nc)
                 r = results[key] if key in results else '...'
                 line = str(r)
-                if r == 'UND' or r == 'TIMEOUT' or r == 'ERROR':
+                if r == 'UND' or r == 'TIMEOUT' or r == 'ERROR' or r == 'MEM':
                     line = OKBLUE+str(r)
                 elif r is None :
                     line = FAIL+str(r)
                 elif r != '...':
                     line = OKGREEN+str(r)
-                if key == i:
+                if key == current:
                     line = BOLD+line
                 print(line+ENDC, end='\t', flush=True)
             else:
                 print(end='\t', flush=True)
         print(flush=True)
-    #print([(results[i] if i in results else '') for i in range(max(results.keys())+1)])
 
-def log_error(error):
-    print('got error: {}'.format(error), flush=True)
-    raise error
+class MemoryBudget:
+    """
+    Resident memory (in MB) that solver jobs may use at the same time, shared
+    by the jobs of one or more searches (use it with their lock held). With
+    'auto', the budget is taken from the POLYCUBES_MEMORY_BUDGET environment
+    variable, defaulting to 80% of the physical memory. An empty budget (or
+    None) disables admission control.
+    """
+    def __init__(self, limitMB='auto'):
+        if limitMB == 'auto':
+            limitMB = os.environ.get('POLYCUBES_MEMORY_BUDGET')
+            if limitMB is None:
+                limitMB = 0.8 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1 << 20)
+        self.limit = float(limitMB) if limitMB else None
+        self.used = 0
+
+    def fits(self, mb):
+        """ whether a job of mb can start now """
+        return self.limit is None or self.used + mb <= self.limit
+
+    def too_large(self, mb):
+        """ whether a job of mb can never start, even alone """
+        return self.limit is not None and mb > self.limit
+
+    def acquire(self, mb):
+        self.used += mb
+
+    def release(self, mb):
+        self.used -= mb
+
+class NonDaemonicProcess(multiprocessing.Process):
+    """ process that may start processes of its own, as polysat.solve_portfolio does """
+    @property
+    def daemon(self):
+        return False
+
+    @daemon.setter
+    def daemon(self, value):
+        pass
 
-def parallelFindMinimalRule(top, maxCubeTypes='auto', maxColors='auto', nSolutions=100, nDim=3, torsionalPatches=True):
+class NonDaemonicContext(type(multiprocessing.get_context())):
+    Process = NonDaemonicProcess
+
+def solverContext(portfolio=False):
+    """ multiprocessing context for a pool of solver jobs, with workers that can race solvers if portfolio is set """
+    return NonDaemonicContext() if portfolio else multiprocessing.get_context()
+
+class MinimalRuleSearch:
+    """
+    Runs findRuleFor for each (nCubeTypes, nColors) on a process pool, in
+    order of increasing size, until the minimal rule is settled. Jobs are
+    submitted as workers become free, so jobs with at least as many species
+    and colors as an already found rule are never started. The main thread
+    sleeps until a job finishes, and the pool (with any jobs still running)
+    is terminated as soon as the outcome is known.
+
+    Among the next lookahead undecided points, the one that bounds the most
+    others is first probed with probeRuleBound. If there is no rule within
+    it, all points below it are ruled out without being solved.
+
+    Jobs are only started while their estimated memory (see
+    polysat.estimate_memory) fits in the memory budget, so the biggest jobs
+    wait until they can run alone. Jobs that do not fit even then are not
+    run, and get the result 'MEM'. Those cannot be ruled out, so a rule
+    found with any of them before it is not proven to be minimal (see
+    unproven).
+
+    With portfolio, each job races several SAT solvers (see
+    polysat.solve_portfolio), in a pool from solverContext(True). Each job
+    then uses up to one process per CPU, so fewer processes are needed.
+
+    Several searches can share a pool (see runSearches), by passing them
+    the same lock, changed event and memory budget.
+    """
+    probeTimeout = 600 # Seconds a probe may take before it is given up, without ruling anything out
+
+    def __init__(self, top, maxCubeTypes, maxColors, nSolutions=100, nDim=3, torsionalPatches=True, nProcesses=None, lookahead=None, verbose=True, lock=None, changed=None, budget=None, portfolio=False):
+        self.top = top
+        self.nParticles, self.nBindings = utils.countParticlesAndBindings(top)
+        self.verbose = verbose
+        self.nSolutions = nSolutions
+        self.nDim = nDim
+        self.torsionalPatches = torsionalPatches
+        self.portfolio = portfolio
+        self.nProcesses = nProcesses or os.cpu_count()
+        self.lookahead = lookahead or 4*self.nProcesses
+        self.pending = smartEnumerate(maxCubeTypes, maxColors)
+        self.results = {}
+        self.probed = set()     # points probed with probeRuleBound
+        self.implied = set()    # points ruled out by a probe
+        self.nRunning = 0
+        self.settled = False
+        self.finalResult = None
+        self.unproven = []      # 'MEM' points that could have held a smaller rule than finalResult
+        self.lock = lock or threading.Lock()
+        self.changed = changed or threading.Event()
+        self.budget = budget or MemoryBudget()
+        self.refuse_oversized()
+
+    @property
+    def done(self):
+        return self.settled or (not self.pending and self.nRunning == 0)
+
+    def next_cost(self):
+        """ rough cost of the next job, for running cheap jobs first """
+        nCubeTypes, nColors = self.pending[0]
+        return self.nParticles * nCubeTypes * nColors
+
+    def report(self, text):
+        if self.verbose:
+            print(text, flush=True)
+
+    def dominated(self, nCubeTypes, nColors):
+        """ whether a rule was already found with at most nCubeTypes species and nColors colors """
+        return any(isValidRule(r) and nCubeTypes >= nT and nColors >= nC for (nT, nC), r in self.results.items())
+
+    def job_memory(self, key):
+        """ estimated peak memory in MB of the job for key (nCubeTypes, nColors) """
+        mb = polysat.estimate_memory(self.nParticles, self.nBindings, key[0], key[1], self.nDim, self.torsionalPatches)
+        if self.portfolio:
+            # Each racing solver builds its own copy of the formula
+            mb *= 1 + len(polysat.default_portfolio())
+        return mb
+
+    def refuse_oversized(self):
+        """ gives the result 'MEM' to pending points that would not fit in the memory budget """
+        for key in self.pending:
+            if self.budget.too_large(self.job_memory(key)):
+                self.report('\n{} colors and {} cube types: Needs about {:.0f} MB, more than the budget of {:.0f} MB'.format(
+                    key[1], key[0], self.job_memory(key), self.budget.limit))
+                self.results[key] = 'MEM'
+        self.pending = [k for k in self.pending if k not in self.results]
+
+    def rule_out_below(self, nCubeTypes, nColors):
+        """ records that there is no rule with at most nCubeTypes species and nColors colors """
+        for nT in range(1, nCubeTypes+1):
+            for nC in range(1, nColors+1):
+                self.results[(nT, nC)] = None
+                self.implied.add((nT, nC))
+        self.pending = [k for k in self.pending if k not in self.implied]
+
+    def next_job(self):
+        """ the next job to submit, as (function, (nCubeTypes, nColors)), or None if it has to wait for memory """
+        window = self.pending[:self.lookahead]
+        gains = [(sum(x <= nT and y <= nC for x, y in window), (nT, nC)) for nT, nC in window
+                 if (nT, nC) not in self.probed and self.budget.fits(self.job_memory((nT, nC)))]
+        if gains:
+            gain, key = max(gains)
+            if gain > 1:
+                # Worth probing, as it could rule out other points as well
+                self.probed.add(key)
+                return probeRuleBound, key
+        if not self.budget.fits(self.job_memory(self.pending[0])):
+            # Wait, rather than letting smaller jobs take the memory it needs
+            return None
+        return findRuleFor, self.pending.pop(0)
+
+    def check_settled(self):
+        # A rule is final once all simpler (nCubeTypes, nColors) have been ruled out,
+        # or left out for memory, in which case it may not be the minimal rule
+        for nCubeTypes, nColors in sorted(k for k, r in self.results.items() if isValidRule(r)):
+            simpler = []
+            for key in smartEnumerate(nCubeTypes, nColors):
+                if not key in self.results:
+                    break
+                if isValidRule(self.results[key]):
+                    self.settled = True
+                    self.finalResult = self.results[key]
+                    self.unproven = [k for k in simpler if self.results[k] == 'MEM']
+                    if self.unproven:
+                        self.report('Finished, but not proven minimal: {} did not fit in the memory budget'.format(formatPoints(self.unproven)))
+                    else:
+                        self.report('Finished!')
+                    return
+                simpler.append(key)
+
+    def give_up(self):
+        """ records that there is no rule left to try, which is not proven if any points got 'MEM' """
+        self.unproven = sorted(k for k, r in self.results.items() if r == 'MEM')
+        if self.unproven:
+            self.report('Sorry, no solution found, but {} did not fit in the memory budget'.format(formatPoints(self.unproven)))
+        else:
+            self.report('Sorry, no solution')
+
+    def on_result(self, result):
+        i, rule, log = result
+        key = tuple(int(e) for e in i.split(','))
+        with self.lock:
+            self.nRunning -= 1
+            self.budget.release(self.job_memory(key))
+            if key not in self.implied:
+                self.results[key] = rule
+            if isValidRule(rule):
+                polyurl = "https://akodiat.github.io/polycubes?decRule={}"
+                log += 'Found solution: '+polyurl.format(rule)
+                self.pending = [k for k in self.pending if not self.dominated(*k)]
+            self.report(log)
+            self.check_settled()
+            if self.verbose:
+                printResultGrid(self.results, key)
+            self.changed.set()
+
+    def on_probe(self, result):
+        i, bounded = result
+        key = tuple(int(e) for e in i.split(','))
+        with self.lock:
+            self.nRunning -= 1
+            self.budget.release(self.job_memory(key))
+            # A rule or a timeout rules nothing out, the points themselves still get solved
+            if bounded == False:
+                self.report('\nNo rule with at most {} colors and {} cube types'.format(key[1], key[0]))
+                self.rule_out_below(*key)
+                self.check_settled()
+                if self.verbose:
+                    printResultGrid(self.results, key)
+            self.changed.set()
+
+    def on_error(self, key, error, probe=False):
+        with self.lock:
+            self.report('got error: {}'.format(error))
+            self.nRunning -= 1
+            self.budget.release(self.job_memory(key))
+            if not probe and key not in self.implied:
+                # A failed probe is not a result, the point itself still gets solved
+                self.results[key] = 'ERROR'
+                self.check_settled()
+            self.changed.set()
+
+    def submit(self, p):
+        """ submits the next job to pool p (call with the lock held). Returns False if it has to wait for memory """
+        job = self.next_job()
+        if job is None:
+            return False
+        job, (nCubeTypes, nColors) = job
+        self.nRunning += 1
+        self.budget.acquire(self.job_memory((nCubeTypes, nColors)))
+        if job == probeRuleBound:
+            p.apply_async(
+                probeRuleBound,
+                args = (self.top, nCubeTypes, nColors, self.nDim, self.torsionalPatches, self.probeTimeout),
+                callback = self.on_probe,
+                error_callback = functools.partial(self.on_error, (nCubeTypes, nColors), probe=True)
+            )
+        else:
+            p.apply_async(
+                findRuleFor,
+                args = (self.top, nCubeTypes, nColors, self.nSolutions, self.nDim, self.torsionalPatches, self.portfolio),
+                callback = self.on_result,
+                error_callback = functools.partial(self.on_error, (nCubeTypes, nColors))
+            )
+        return True
+
+    def run(self):
+        runSearches([self], self.nProcesses)
+        return self.finalResult
+
+def runSearches(searches, nProcesses, onProgress=None):
+    """Run several minimal rule searches on one pool of nProcesses workers,
+    submitting the cheapest job of any search whenever a worker is free.
+    The searches have to share their lock, changed event and memory budget.
+    A job that has to wait for memory does not hold up the (possibly
+    smaller) jobs of the other searches.
+
+    Args:
+        searches (list): MinimalRuleSearch instances
+        nProcesses (int): Number of jobs to run at the same time
+        onProgress (function, optional): Called with the lock held whenever a job finishes, with the list of searches that are done since the last call. Defaults to None.
+    """
+    lock, changed = searches[0].lock, searches[0].changed
+    active = list(searches)
+    portfolio = any(s.portfolio for s in searches)
+    # Each worker only runs one job, so that its peak memory is that job's
+    with solverContext(portfolio).Pool(nProcesses, maxtasksperchild=1) as p:
+        while True:
+            with lock:
+                # Jobs of settled searches may still be running
+                while sum(s.nRunning for s in searches) < nProcesses:
+                    candidates = sorted((s for s in active if s.pending and not s.settled), key=lambda s: s.next_cost())
+                    if not any(s.submit(p) for s in candidates):
+                        break
+                finished = [s for s in active if s.done]
+                for search in finished:
+                    if not search.settled:
+                        # Nothing left to try
+                        search.give_up()
+                    active.remove(search)
+                if onProgress:
+                    onProgress(finished)
+                if not active:
+                    break
+                # Cleared under the lock, so a callback cannot be missed
+                changed.clear()
+            changed.wait()
+    # Leaving the pool terminates any jobs still running
+
+def parallelFindMinimalRule(top, maxCubeTypes='auto', maxColors='auto', nSolutions=100, nDim=3, torsionalPatches=True, nProcesses=None, lookahead=None, memoryBudget='auto', portfolio=False):
     # Never need to check for more than the topology can specify
     maxNT, maxNC = utils.countParticlesAndBindings(top)
     if maxCubeTypes == 'auto':
         maxCubeTypes = maxNT
     if maxColors == 'auto':
         maxColors = maxNC
-    global ongoing
-    asyncResults = []
-    with multiprocessing.Pool(maxtasksperchild=1) as p:
-        for nCubeTypes, nColors in smartEnumerate(maxCubeTypes, maxColors):
-            r = p.apply_async(
-                findRuleFor,
-                args = (top, nCubeTypes, nColors, nSolutions, nDim, torsionalPatches),
-                callback = log_result,
-                error_callback = log_error
-            )
-            asyncResults.append(r)
-        while not finalResult:
-            pass
-        return finalResult
+    search = MinimalRuleSearch(
+        top, maxCubeTypes, maxColors, nSolutions, nDim, torsionalPatches,
+        nProcesses, lookahead, budget=MemoryBudget(memoryBudget), portfolio=portfolio
+    )
+    return search.run()
+
+def sweepFindMinimalRule(top, maxCubeTypes='auto', maxColors='auto', nSolutions=100, nDim=3, torsionalPatches=True):
+    """Find the minimal rule with a single encoding for the maximum number of
+    species and colors, solving each (nCubeTypes, nColors) on the same solver
+    by assuming selector literals.
+
+    Args:
+        top: Topology, as a list of bindings
+        maxCubeTypes (int, optional): Maximum number of species. Defaults to 'auto'.
+        maxColors (int, optional): Maximum number of colors. Defaults to 'auto'.
+        nSolutions (int, optional): Number of solutions to try if they are UND. Defaults to 100.
+
+    Returns:
+        string: The minimal rule, or None if there is none
+    """
+    maxNT, maxNC = utils.countParticlesAndBindings(top)
+    if maxCubeTypes == 'auto':
+        maxCubeTypes = maxNT
+    if maxColors == 'auto':
+        maxColors = maxNC
+
+    mysat = polysat(top, maxCubeTypes, maxColors, nDim, torsionalPatches, selectors=True)
+    print("Using {} variables and {} clauses".format(mysat.nVars, len(mysat.basic_sat_clauses)), flush=True)
+
+    cores = [] # Assumption sets known to be unsatisfiable
+    for nCubeTypes, nColors in smartEnumerate(maxCubeTypes, maxColors):
+        log = '\n{} colors and {} cube types: '.format(nColors, nCubeTypes)
+        assumptions = mysat.assumptions_for(nCubeTypes, nColors)
+        if any(core <= set(assumptions) for core in cores):
+            print(log + 'Sorry, no solution (implied by an earlier core)', flush=True)
+            continue
+        for nTries in range(nSolutions):
+            result, solution = mysat.solve(assumptions=assumptions)
+            if not result:
+                if nTries == 0:
+                    cores.append(mysat.unsat_core())
+                    bounds = mysat.failed_bounds()
+                    if bounds:
+                        log += 'Sorry, no solution (bounded by {})'.format(' and '.join(bounds))
+                    else:
+                        log += 'Sorry, no solution'
+                else:
+                    log += '  All UND'
+                break
+            rule = sorted(readSolution(solution), key=patchCount, reverse=True)
+            decRule = utils.ruleToDec(rule)
+            if libpolycubes.isBoundedAndDeterministic(decRule, isHexString=False):
+                polyurl = "https://akodiat.github.io/polycubes?decRule={}"
+                print(log + 'Found solution: ' + polyurl.format(decRule), flush=True)
+                return decRule
+            log += '{} is UND\n'.format(decRule)
+            # Only block this solution for the current number of species and colors
+            mysat.forbidSolution(solution, assumptions)
+        else:
+            log += '  All UND'
+        print(log, flush=True)
+    return None
+
+def optimalFindMinimalRule(top, maxCubeTypes='auto', maxColors='auto', nSolutions=100, nDim=3, torsionalPatches=True, weights=(1, 1), method='cardinality'):
+    """Find the minimal rule by minimising the weighted number of species and
+    colors in a single encoding, rather than solving each (nCubeTypes, nColors)
+    separately. Optimal rules that are UND are blocked for their number of
+    species and colors, and the minimisation is repeated.
+
+    Args:
+        top: Topology, as a list of bindings
+        maxCubeTypes (int, optional): Maximum number of species. Defaults to 'auto'.
+        maxColors (int, optional): Maximum number of colors. Defaults to 'auto'.
+        nSolutions (int, optional): Number of solutions to try for each number of species and colors if they are UND. Defaults to 100.
+        weights (tuple, optional): Cost of a species and of a color. Defaults to (1, 1).
+        method (str, optional): 'cardinality' or 'rc2', see polysat.minimize_rule. Defaults to 'cardinality'.
+
+    Returns:
+        string: The minimal rule, or None if there is none
+    """
+    maxNT, maxNC = utils.countParticlesAndBindings(top)
+    if maxCubeTypes == 'auto':
+        maxCubeTypes = maxNT
+    if maxColors == 'auto':
+        maxColors = maxNC
+
+    mysat = polysat(top, maxCubeTypes, maxColors, nDim, torsionalPatches, selectors=True)
+    print("Using {} variables and {} clauses".format(mysat.nVars, len(mysat.basic_sat_clauses)), flush=True)
+
+    nTries = {}
+    while True:
+        result, solution, counts = mysat.minimize_rule(weights, method)
+        if not result:
+            print('Sorry, no solution', flush=True)
+            return None
+        nCubeTypes, nColors = counts
+        log = '\n{} colors and {} cube types: '.format(nColors, nCubeTypes)
+        rule = sorted(readSolution(solution), key=patchCount, reverse=True)
+        decRule = utils.ruleToDec(rule)
+        if libpolycubes.isBoundedAndDeterministic(decRule, isHexString=False):
+            polyurl = "https://akodiat.github.io/polycubes?decRule={}"
+            print(log + 'Found optimal solution: ' + polyurl.format(decRule), flush=True)
+            return decRule
+        # Only block this solution for the current number of species and colors,
+        # or all of them once nSolutions have been UND
+        assumptions = mysat.assumptions_for(nCubeTypes, nColors)
+        nTries[counts] = nTries.get(counts, 0) + 1
+        if nTries[counts] < nSolutions:
+            print(log + '{} is UND'.format(decRule), flush=True)
+            mysat.forbidSolution(solution, assumptions)
+        else:
+            print(log + '{} is UND\n  All UND'.format(decRule), flush=True)
+            mysat.forbidSolution('', assumptions)
 
 def findRules(topPath, nCubeTypes='auto', nColors='auto', nSolutions='auto', nDim=3, torsionalPatches=True):
     polyurl = "https://akodiat.github.io/polycubes?rule={}"
@@ -258,7 +727,7 @@ def findRules(topPath, nCubeTypes='auto', nColors='auto', nSolutions='auto', nDi
         print('Sorry, no solution found', flush=True)
         return
 
-def solve(solveSpecPath, nCubeTypes=None, nColors=None):
+def solve(solveSpecPath, nCubeTypes=None, nColors=None, sweep=False, optimal=False, portfolio=False):
     with open(solveSpecPath, 'r') as f:
         data = f.read()
     solveSpec = json.loads(data)
@@ -268,33 +737,103 @@ def solve(solveSpecPath, nCubeTypes=None, nColors=None):
             solveSpec['bindings'],
             nCubeTypes, nColors, nSolutions=1000,
             nDim=solveSpec['nDim'],
-            torsionalPatches=solveSpec['torsion']
+            torsionalPatches=solveSpec['torsion'],
+            portfolio=portfolio
         )
         print(log)
         print(rules)
         return rules
+    elif optimal:
+        return optimalFindMinimalRule(
+            solveSpec['bindings'],
+            nDim=solveSpec['nDim'],
+            torsionalPatches=solveSpec['torsion']
+        )
+    elif sweep:
+        return sweepFindMinimalRule(
+            solveSpec['bindings'],
+            nDim=solveSpec['nDim'],
+            torsionalPatches=solveSpec['torsion']
+        )
     else:
         return parallelFindMinimalRule(
             solveSpec['bindings'],
             nDim=solveSpec['nDim'],
-            torsionalPatches=solveSpec['torsion']
+            torsionalPatches=solveSpec['torsion'],
+            portfolio=portfolio
         )
 
-def newSolve(solveSpecPath, nCubeTypes, nColors, ratioLimit=1.0, maxTries=1000):
+def assemblyStatus(result):
+    """ 'SAT', 'UNSAT', 'UND' or 'TIMEOUT' for an assembleRuleFor result """
+    if isinstance(result, str) and result != 'TIMEOUT':
+        return 'SAT'
+    return 'UNSAT' if result is None else 'TIMEOUT' if result == 'TIMEOUT' else 'UND'
+
+def newSolve(solveSpecPath, nCubeTypes, nColors, ratioLimit=1.0, maxTries=1000, cachePath='auto', nWorkers=0, telemetryPath='auto'):
     print("Solving {} for {}s {}c on pid={}".format(solveSpecPath, nCubeTypes, nColors, os.getpid()))
     with open(solveSpecPath, 'r') as f:
         data = f.read()
     solveSpec = json.loads(data)
-
-    mysat = polysat(
-        solveSpec['bindings'],
-        nCubeTypes,
-        nColors,
-        solveSpec['nDim'],
-        solveSpec['torsion']
+    method = 'newSolve(ratioLimit={}, maxTries={}), {}'.format(ratioLimit, maxTries, polysat.encoding_key())
+    telemetry = JobTelemetry(
+        telemetryPath, shape=solveSpecPath, topology=solveCache.topologyHash(solveSpec['bindings']),
+        nCubeTypes=nCubeTypes, nColors=nColors, nDim=solveSpec['nDim'],
+        torsion=solveSpec['torsion'], method=method
     )
 
-    nVars = max(mysat.variables.values())
+    # Check the solve cache (see solveCache.openCache) first
+    cache = solveCache.openCache(cachePath)
+    key = (solveSpec['bindings'], solveSpec['nDim'], solveSpec['torsion'], nCubeTypes, nColors, method)
+    if cache is not None:
+        cached = cache.get(*key)
+        if cached is not None:
+            status, result = cached
+            print("Using cached result ({})".format(status))
+            if status == 'SAT':
+                print("Found solution: https://akodiat.github.io/polycubes/?decRule={}".format(result))
+            elif status == 'UNSAT':
+                print("No solution possible")
+            cache.close()
+            telemetry.finish(status=status, result=result, cached=True)
+            return result
+    start = time.time()
+    result = assembleRuleFor(solveSpec, nCubeTypes, nColors, ratioLimit, maxTries, nWorkers, telemetry)
+    status = assemblyStatus(result)
+    telemetry.finish(status=status, result=result, cached=False)
+    if cache is not None:
+        cache.put(*key, status, result if status == 'SAT' else None, result, time.time() - start)
+        cache.close()
+    return result
+
+def assemblyRatio(shape, decRule, torsion):
+    return libpolycubes.assembleRatio(shape, decRule, isHexString=False, assemblyMode='seeded', torsion=torsion)
+
+def assembleRuleFor(solveSpec, nCubeTypes, nColors, ratioLimit=1.0, maxTries=1000, nWorkers=0, telemetry=None):
+    """Find a rule for the given number of species and colors that assembles
+    the shape(s) of solveSpec at an assembly ratio of at least ratioLimit.
+    With nWorkers > 0, candidates are validated by that many processes while
+    the solver finds the next ones (see pipelinedAssembleRuleFor).
+    If a JobTelemetry is given, the time spent encoding, solving and
+    validating is added to it.
+
+    Returns:
+        The decimal rule, 'TIMEOUT', None if there is no solution, or the
+        highest assembly ratio seen if no rule reached ratioLimit (also when
+        the solver runs out of candidates after rejecting some, as the
+        formula itself was satisfiable)
+    """
+    telemetry = telemetry or JobTelemetry(path=None)
+    with telemetry.timed('encodingSeconds'):
+        mysat = polysat(
+            solveSpec['bindings'],
+            nCubeTypes,
+            nColors,
+            solveSpec['nDim'],
+            solveSpec['torsion']
+        )
+    telemetry.encoded(mysat)
+
+    nVars = mysat.nVars
     nClauses = len(mysat.basic_sat_clauses)
     print("Using {} variables and {} clauses".format(nVars, nClauses))
 
@@ -303,18 +842,25 @@ def newSolve(solveSpecPath, nCubeTypes, nColors, ratioLimit=1.0, maxTries=1000):
     if len(shapes) > 1:
         print("Multifarious assembly")
 
+    if nWorkers > 0:
+        return pipelinedAssembleRuleFor(mysat, shapes, solveSpec['torsion'], ratioLimit, maxTries, nWorkers, telemetry)
+
     nTries = 0
     maxRatio = 0
     while nTries < maxTries:
-        result, solution = mysat.solve(3600) # Timeout after one hour
+        with telemetry.timed('solverSeconds'):
+            result, solution = mysat.solve(3600) # Timeout after one hour
         if result == 'TIMEOUT':
             print('Sorry, timed out')
+            return result
         elif result:
             rule = sorted(readSolution(solution), key=patchCount, reverse=True)
             decRule = utils.ruleToDec(rule)
+            telemetry.count('candidates')
             ratiosum = 0
             for shape in shapes:
-                ratio = libpolycubes.assembleRatio(shape, decRule, isHexString=False, assemblyMode='seeded', torsion=solveSpec['torsion'])
+                with telemetry.timed('validationSeconds'):
+                    ratio = libpolycubes.assembleRatio(shape, decRule, isHexString=False, assemblyMode='seeded', torsion=solveSpec['torsion'])
                 if ratio == 0:
                     print("Shape {} never assembled (tried {})".format((("{}").format(shape) if len(shapes)>1 else ''), utils.ruleToDec(rule)))
                     ratiosum = 0
@@ -330,20 +876,96 @@ def newSolve(solveSpecPath, nCubeTypes, nColors, ratioLimit=1.0, maxTries=1000):
                     maxRatio = max(maxRatio, ratiosum)
                 mysat.forbidSolution(solution)
                 nTries += 1
-        else:
+        elif nTries == 0:
             print("No solution possible")
             return None
+        else:
+            print("No more solutions after {} tries".format(nTries))
+            return maxRatio
+    print("No valid solution found after {} tries".format(maxTries))
+    return maxRatio
+
+def pipelinedAssembleRuleFor(mysat, shapes, torsion, ratioLimit, maxTries, nWorkers, telemetry):
+    """The candidate loop of assembleRuleFor, but with the solver producing
+    (and blocking) new candidate rules while earlier ones are validated in
+    a pool of nWorkers processes, with one assembly job per candidate and
+    shape. Returns as soon as any candidate reaches ratioLimit.
+    Only the time spent waiting for validations is counted as
+    validationSeconds, as the rest overlaps with solving.
+    """
+    nTries = 0
+    maxRatio = 0
+    exhausted = False
+    candidates = [] # (decRule, assembly ratio futures) being validated
+    executor = concurrent.futures.ProcessPoolExecutor(nWorkers)
+    try:
+        while True:
+            # Queue enough candidates to keep all workers busy
+            while not exhausted and nTries < maxTries and len(candidates) < 2*nWorkers:
+                with telemetry.timed('solverSeconds'):
+                    result, solution = mysat.solve(3600) # Timeout after one hour
+                if result == 'TIMEOUT':
+                    print('Sorry, timed out')
+                    return result
+                elif not result:
+                    exhausted = True
+                    break
+                rule = sorted(readSolution(solution), key=patchCount, reverse=True)
+                decRule = utils.ruleToDec(rule)
+                mysat.forbidSolution(solution)
+                nTries += 1
+                telemetry.count('candidates')
+                candidates.append((decRule, [executor.submit(assemblyRatio, shape, decRule, torsion) for shape in shapes]))
+            if not candidates:
+                break
+            with telemetry.timed('validationSeconds'):
+                concurrent.futures.wait(
+                    [f for _, futures in candidates for f in futures],
+                    return_when=concurrent.futures.FIRST_COMPLETED
+                )
+            for candidate in list(candidates):
+                decRule, futures = candidate
+                ratios = [f.result() for f in futures if f.done()]
+                if 0 in ratios:
+                    shape = shapes[[f.done() and f.result() == 0 for f in futures].index(True)]
+                    print("Shape {} never assembled (tried {})".format((("{}").format(shape) if len(shapes)>1 else ''), decRule))
+                    for f in futures:
+                        f.cancel()
+                    candidates.remove(candidate)
+                elif len(ratios) == len(futures):
+                    ratiosum = sum(ratios)
+                    if ratiosum >= ratioLimit:
+                        print("Found solution: https://akodiat.github.io/polycubes/?decRule={} at assembly ratio {}".format(decRule, ratiosum))
+                        return decRule
+                    print("Solution {} assembles, but only at assembly ratio {}. {} tries left".format(decRule, ratiosum, maxTries-nTries))
+                    maxRatio = max(maxRatio, ratiosum)
+                    candidates.remove(candidate)
+    finally:
+        # Don't wait for validations that are no longer needed
+        executor.shutdown(wait=False, cancel_futures=True)
+    if exhausted and nTries == 0:
+        print("No solution possible")
+        return None
+    if exhausted:
+        print("No more solutions after {} tries".format(nTries))
+        return maxRatio
     print("No valid solution found after {} tries".format(maxTries))
     return maxRatio
 
 if __name__ == '__main__':
     import time
     start = time.time()
-    if len(sys.argv) > 3:
+    # Race several SAT solvers for each job (see polysat.solve_portfolio)
+    portfolio = '--portfolio' in sys.argv
+    if portfolio:
+        sys.argv.remove('--portfolio')
+    if len(sys.argv) > 4:
+        print(newSolve(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), nWorkers=int(sys.argv[4])))
+    elif len(sys.argv) > 3:
         print(newSolve(sys.argv[1], int(sys.argv[2]), int(sys.argv[3])))
     elif len(sys.argv) > 1:
-        solve(sys.argv[1]);
+        solve(sys.argv[1], portfolio=portfolio);
     else:
-        print("Need to provide path to a shape json file [shapePath, nCubeTypes, nColors]")
+        print("Need to provide path to a shape json file [shapePath, nCubeTypes, nColors, nWorkers], with --portfolio to race several SAT solvers when finding the minimal rule")
     end = time.time()
     print("Finished in {} seconds".format(end-start))
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+## On-disk cache of solve results, so that re-running a shape (or an
+## overlapping sweep) only has to solve new (nCubeTypes, nColors) points
+
+def topologyHash(top):
+    """Hash of a topology that does not depend on the order of the bindings,
+    or on which end of a binding is listed first.
+
+    Args:
+        top: Topology, as a list of bindings [particle1, patch1, particle2, patch2]
+
+    Returns:
+        string: Hex digest
+    """
+    bindings = sorted(
+        tuple(b) if tuple(b[:2]) <= tuple(b[2:]) else tuple(b[2:]) + tuple(b[:2])
+        for b in top
+    )
+    return hashlib.sha1(json.dumps(bindings).encode()).hexdigest()
+
+def connectDatabase(path, **kwargs):
+    """Connect to an SQLite file that several processes, on any hosts that
+    share its file system, use at the same time. The default rollback
+    journal is kept, as WAL mode needs shared memory, which does not work
+    between hosts on a network file system. Writers wait up to 10 minutes
+    for the lock.
+
+    Args:
+        path (str): Path to the SQLite file
+        kwargs: Further arguments to sqlite3.connect
+
+    Returns:
+        sqlite3.Connection
+    """
+    return sqlite3.connect(path, timeout=600, **kwargs)
+
+def openCache(path='auto'):
+    """Open the solve cache at path. With 'auto', the path is taken from the
+    POLYCUBES_SOLVE_CACHE environment variable, and caching is off if it is
+    not set. An empty path (or None) disables caching.
+
+    Returns:
+        SolveCache, or None if caching is disabled
+    """
+    if path == 'auto':
+        path = os.environ.get('POLYCUBES_SOLVE_CACHE')
+    return SolveCache(path) if path else None
+
+class SolveCache:
+    """
+    SQLite table of results per topology, nDim, torsion, nCubeTypes, nColors
+    and solve method (including the method's settings, since for example a
+    rule found by newSolve depends on its ratioLimit, and which rule is found
+    first depends on the encoding). Several processes can share the same file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = connectDatabase(path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS results (
+            topology TEXT, nDim INTEGER, torsion INTEGER,
+            nCubeTypes INTEGER, nColors INTEGER, method TEXT,
+            status TEXT, rule TEXT, result TEXT, seconds REAL, created REAL,
+            PRIMARY KEY (topology, nDim, torsion, nCubeTypes, nColors, method)
+        )''')
+        self.db.commit()
+
+    def get(self, top, nDim, torsion, nCubeTypes, nColors, method):
+        """Look up a result. UNSAT is the same for all methods, so it is
+        returned for any of them. Timeouts are not returned, so that they
+        are tried again.
+
+        Returns:
+            tuple: (status, result) as stored by put(), or None if not cached
+        """
+        rows = self.db.execute(
+            '''SELECT method, status, result FROM results WHERE topology=? AND nDim=?
+            AND torsion=? AND nCubeTypes=? AND nColors=? AND status != 'TIMEOUT' ''',
+            (topologyHash(top), nDim, int(torsion), nCubeTypes, nColors)
+        ).fetchall()
+        for m, status, result in rows:
+            if m == method or status == 'UNSAT':
+                return status, json.loads(result)
+        return None
+
+    def put(self, top, nDim, torsion, nCubeTypes, nColors, method, status, rule, result, seconds):
+        """Store a result
+
+        Args:
+            status (str): 'SAT', 'UNSAT', 'UND' or 'TIMEOUT'
+            rule (str): Decimal rule if one was found, otherwise None
+            result: The method's return value (has to be JSON serialisable)
+            seconds (float): Time it took to solve
+        """
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                (topologyHash(top), nDim, int(torsion), nCubeTypes, nColors, method,
+                 status, rule, json.dumps(result), seconds, time.time())
+            )
+
+    def close(self):
+        self.db.close()
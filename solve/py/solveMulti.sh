@@ -7,6 +7,9 @@ n=$(basename "$1" .json)
 
 mkdir -p $n
 
+# Solver jobs append their timings and results here (see solvePlot.getTelemetry)
+export POLYCUBES_TELEMETRY="$(pwd)/$n/telemetry.jsonl"
+
 read -r maxNT maxNC <<< $(python -c "
 import json;
 import utils;
@@ -20,15 +23,9 @@ print(maxNT, maxNC)
 echo "Max number of cube types is $maxNT"
 echo "Max number of colors is $maxNC"
 
-for f in $(python -c "import solve; [print('{}:{}'.format(nt,nc)) for nt, nc in solve.smartEnumerate($maxNT, $maxNC)]"); do
-    IFS=':' read -r nT nC <<< "$f"
-
-    echo "Scheduling $n with $nT cube types and $nC colors"
-
-    # Pad with zeroes to make sure things are sorted correctly
-    printf -v paddedNT "%0$(echo -n $maxNT | wc -m)d" $nT
-    printf -v paddedNC "%0$(echo -n $maxNC | wc -m)d" $nC
-
-    # nohup python solve.py $1 $nT $nC > "$n/${paddedNT}t_${paddedNC}c.out" &
-    python solve.py $1 $nT $nC > "$n/${paddedNT}t_${paddedNC}c.out"
-done
+# Queue all species and colour combinations, and solve them until the minimal
+# rule is known (see solveQueue.py). Run more workers on the same queue file,
+# from any host, to solve in parallel.
+python solveQueue.py add "$n/queue.sqlite" $1 $maxNT $maxNC
+python solveQueue.py work "$n/queue.sqlite"
+python solveQueue.py status "$n/queue.sqlite"
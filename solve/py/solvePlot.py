@@ -1,7 +1,9 @@
 import os
 import re
+import json
 import altair as alt
 import pandas as pd
+from solveCache import connectDatabase
 
 colordomain = ['Solution', 'None', 'UND', 'MEM']
 colorrange = ['#4DAF4A', '#E41A1C', '#377EB8', '#170EB8']
@@ -15,14 +17,123 @@ def isNumber(s):
     except ValueError:
         return False
 
+def getTelemetry(path):
+    """Read the results of the telemetry records written by the solver
+    (see telemetry.JobTelemetry), with the same columns as getResults.
+    Jobs that were killed (out of memory, say) leave no record, so
+    getResults takes those from the job logs.
+    """
+    categories = {'SAT': 'Solution', 'UNSAT': 'None', 'UND': 'UND', 'TIMEOUT': 'TIMEOUT', 'ERROR': 'Error'}
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Last line may only be partly written if a job was killed
+                continue
+    results = []
+    for record in records:
+        status = record['status']
+        result = record['result']
+        ratio = 1.0 if status == 'SAT' else 0.0
+        if status == 'UND' and isNumber(str(result)):
+            # Highest assembly ratio seen by newSolve
+            ratio = float(result)
+        results.append({
+            'nCubeTypes': record['nCubeTypes'],
+            'nColors': record['nColors'],
+            'jobID': record['jobID'],
+            'duration': record['totalSeconds'],
+            'variables': record.get('variables'),
+            'clauses': record.get('clauses'),
+            'result': str(result),
+            'category': categories[status],
+            'ratio': ratio,
+            'encodingSeconds': record['encodingSeconds'],
+            'solverSeconds': record['solverSeconds'],
+            'validationSeconds': record['validationSeconds'],
+            'candidates': record['candidates'],
+            'peakRSSMB': record['peakRSSMB'],
+            'cached': record.get('cached', False)
+        })
+    df = pd.DataFrame(results, columns=[
+        'nCubeTypes', 'nColors', 'jobID', 'duration', 'variables', 'clauses', 'result', 'category', 'ratio',
+        'encodingSeconds', 'solverSeconds', 'validationSeconds', 'candidates', 'peakRSSMB', 'cached'
+    ])
+    # Only keep the latest run of each point, where results read from the
+    # solve cache only count if the point was never actually solved
+    df = df.sort_values('cached', ascending=False, kind='stable')
+    return df.drop_duplicates(['nCubeTypes', 'nColors'], keep='last').sort_index()
+
 def getResults(shape, getInProgress=False, getCancelled=False):
+    """Read the results of the jobs for a shape, from the telemetry records
+    in <shape>/telemetry.jsonl where there are any (see getTelemetry), and
+    otherwise from the job logs (see getLogResults). Points without a record,
+    such as jobs killed for memory, in progress or cancelled, are taken from
+    the logs. Tasks that failed in a solve queue are taken from the queue
+    (see getQueueResults).
+    """
+    df = getLogResults(shape, getInProgress, getCancelled)
+    telemetryPath = os.path.join(shape, 'telemetry.jsonl')
+    if os.path.exists(telemetryPath):
+        df = mergeResults(getTelemetry(telemetryPath), df)
+    queuePath = os.path.join(shape, 'queue.sqlite')
+    if os.path.exists(queuePath):
+        # The last attempts of failed tasks may have been killed before
+        # writing a record, so the queue has the final say on those
+        df = mergeResults(getQueueResults(queuePath), df)
+    df.to_csv(shape+'.csv')
+    return df
+
+def mergeResults(df, other):
+    """ results of df, plus those of other for points that are not in df """
+    recorded = set(zip(df['nCubeTypes'], df['nColors']))
+    unrecorded = [key not in recorded for key in zip(other['nCubeTypes'], other['nColors'])]
+    return pd.concat([df, other.loc[unrecorded]], ignore_index=True)
+
+def getQueueResults(path):
+    """Read the tasks that failed in a solve queue (see solveQueue.py), with
+    the same columns as getLogResults. Failed tasks have no telemetry
+    record if their solver was killed, which is most often for memory.
+    """
+    db = connectDatabase(path)
+    rows = db.execute("SELECT nCubeTypes, nColors, log FROM tasks WHERE state='failed'").fetchall()
+    db.close()
+    results = []
+    for nCubeTypes, nColors, log in rows:
+        log = log or ''
+        # Solver processes killed by the out-of-memory killer exit with SIGKILL,
+        # and workers killed by the cluster for memory stop renewing their lease
+        outOfMemory = any(s in log for s in ('exited with code -9', 'MemoryError', 'Lease expired'))
+        results.append({
+            'nCubeTypes': nCubeTypes,
+            'nColors': nColors,
+            'jobID': None,
+            'duration': None,
+            'variables': None,
+            'clauses': None,
+            'result': 'Error',
+            'category': 'MEM' if outOfMemory else 'Error',
+            'ratio': 0.0
+        })
+    return pd.DataFrame(results, columns=['nCubeTypes', 'nColors', 'jobID', 'duration', 'variables', 'clauses', 'result', 'category', 'ratio'])
+
+def getLogResults(shape, getInProgress=False, getCancelled=False):
+    """ results of the jobs for a shape, parsed from their cluster job logs (<shape>/*.out) """
+    files = []
     for root, _, fs in os.walk(shape):
-        files =  [os.path.join(root, f) for f in fs]
+        files =  [os.path.join(root, f) for f in fs if f.endswith('.out')]
         break
     results = []
     inProgressCounter = 0
     cancelledCounter = 0
     for path in files:
+        m = re.search('([0-9]+)t_([0-9]+)c-([0-9]+).out', path)
+        if not m:
+            # Not the log of a solver job (a solve queue worker's, say)
+            continue
+        nCubeTypes, nColors, jobID = (int(g) for g in m.groups())
         with open(path) as f:
             lines = f.readlines()
         
@@ -66,12 +177,10 @@ def getResults(shape, getInProgress=False, getCancelled=False):
         if 'out-of-memory' in lines[-1]:
             category = 'MEM'
 
-        m = re.search('([0-9]+)t_([0-9]+)c-([0-9]+).out', path)
-        #m.group(0)
         results.append({
-            'nCubeTypes': int(m.group(1)),
-            'nColors': int(m.group(2)),
-            'jobID': int(m.group(3)),
+            'nCubeTypes': nCubeTypes,
+            'nColors': nColors,
+            'jobID': jobID,
             'duration': duration,
             'variables': nVars,
             'clauses': nClauses,
@@ -79,8 +188,7 @@ def getResults(shape, getInProgress=False, getCancelled=False):
             'category': category,
             'ratio': ratio
         })
-    df = pd.DataFrame(results)
-    df.to_csv(shape+'.csv')
+    df = pd.DataFrame(results, columns=['nCubeTypes', 'nColors', 'jobID', 'duration', 'variables', 'clauses', 'result', 'category', 'ratio'])
     print("Found {} in progress and {} cancelled".format(inProgressCounter, cancelledCounter))
     return df
 
@@ -0,0 +1,326 @@
+import os
+import sys
+import json
+import time
+import socket
+import contextlib
+import multiprocessing
+import utils
+from solve import smartEnumerate, findRuleFor, newSolve, ruleStatus, assemblyStatus, formatPoints
+from asyncSolve import jobWorker
+from solveCache import connectDatabase
+
+## Work queue of (shape, nCubeTypes, nColors) solve tasks in an SQLite file.
+## Any number of workers, on any hosts that share the file system, claim
+## tasks with a lease that they renew while solving. Tasks of workers that
+## stop renewing are handed out again, failed tasks are retried, and once a
+## shape's minimal rule is known, its remaining tasks are cancelled (which
+## also stops the workers still solving them).
+
+class SolveQueue:
+    """
+    Tasks are 'pending', 'running', 'done', 'failed' or 'cancelled'. Done
+    tasks have a status as in the solve cache ('SAT', 'UNSAT', 'UND' or
+    'TIMEOUT'). Each shape is solved with either newSolve or findRuleFor.
+
+    Failed tasks cannot be ruled out, so, as with 'MEM' points in
+    MinimalRuleSearch, a shape settled with any of them before its rule
+    lists them as unproven, as the rule may not be minimal.
+    """
+    def __init__(self, path):
+        self.path = path
+        # Transactions are started explicitly, so that claiming a task is atomic
+        self.db = connectDatabase(path, isolation_level=None)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS shapes (
+            shape TEXT PRIMARY KEY, method TEXT, nSolutions INTEGER,
+            maxAttempts INTEGER, settled INTEGER, minimalRule TEXT, unproven TEXT
+        )''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS tasks (
+            shape TEXT, nCubeTypes INTEGER, nColors INTEGER, cost INTEGER,
+            state TEXT, worker TEXT, leaseExpires REAL, attempts INTEGER,
+            status TEXT, result TEXT, log TEXT, updated REAL,
+            PRIMARY KEY (shape, nCubeTypes, nColors)
+        )''')
+
+    def close(self):
+        self.db.close()
+
+    def addShape(self, shapePath, maxCubeTypes='auto', maxColors='auto', method='newSolve', nSolutions=100, maxAttempts=3):
+        """Add the tasks of a shape. Adding a shape that is already in the
+        queue does nothing.
+
+        Args:
+            shapePath (str): Path to the shape JSON file (has to be the same on all hosts)
+            maxCubeTypes (int, optional): Maximum number of species. Defaults to 'auto'.
+            maxColors (int, optional): Maximum number of colors. Defaults to 'auto'.
+            method (str, optional): 'newSolve' or 'findRuleFor'. Defaults to 'newSolve'.
+            nSolutions (int, optional): Number of solutions findRuleFor tries if they are UND. Defaults to 100.
+            maxAttempts (int, optional): Number of times a task is tried before it counts as failed. Defaults to 3.
+        """
+        shapePath = os.path.abspath(shapePath)
+        with open(shapePath, 'r') as f:
+            solveSpec = json.loads(f.read())
+        nParticles, nBindings = utils.countParticlesAndBindings(solveSpec['bindings'])
+        if maxCubeTypes == 'auto':
+            maxCubeTypes = nParticles
+        if maxColors == 'auto':
+            maxColors = nBindings
+        now = time.time()
+        with self.transaction():
+            if self.db.execute('SELECT 1 FROM shapes WHERE shape=?', (shapePath,)).fetchone():
+                return
+            self.db.execute(
+                'INSERT INTO shapes VALUES (?,?,?,?,0,NULL,NULL)',
+                (shapePath, method, nSolutions, maxAttempts)
+            )
+            self.db.executemany(
+                "INSERT INTO tasks VALUES (?,?,?,?,'pending',NULL,NULL,0,NULL,NULL,NULL,?)",
+                [(shapePath, nT, nC, nParticles*nT*nC, now) for nT, nC in smartEnumerate(maxCubeTypes, maxColors)]
+            )
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ a transaction that holds the write lock from the start """
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def claim(self, worker, leaseSeconds=60):
+        """Claim the cheapest pending task, leased to worker for leaseSeconds
+
+        Returns:
+            dict: The task (with the shape's method and settings), or None if there is none
+        """
+        now = time.time()
+        with self.transaction():
+            self.expireLeases(now)
+            row = self.db.execute(
+                '''SELECT t.shape, t.nCubeTypes, t.nColors, t.attempts, s.method, s.nSolutions
+                FROM tasks t JOIN shapes s ON t.shape = s.shape
+                WHERE t.state = 'pending' ORDER BY t.cost, t.nCubeTypes + t.nColors LIMIT 1'''
+            ).fetchone()
+            if row is None:
+                return None
+            shape, nT, nC, attempts, method, nSolutions = row
+            self.db.execute(
+                '''UPDATE tasks SET state='running', worker=?, leaseExpires=?, attempts=?, updated=?
+                WHERE shape=? AND nCubeTypes=? AND nColors=?''',
+                (worker, now + leaseSeconds, attempts + 1, now, shape, nT, nC)
+            )
+        return {
+            'shape': shape, 'nCubeTypes': nT, 'nColors': nC,
+            'attempt': attempts + 1, 'method': method, 'nSolutions': nSolutions
+        }
+
+    def expireLeases(self, now):
+        """ hands out tasks of workers that stopped renewing their lease again (call in a transaction) """
+        expired = self.db.execute(
+            "SELECT shape, nCubeTypes, nColors FROM tasks WHERE state='running' AND leaseExpires < ?", (now,)
+        ).fetchall()
+        for shape, nT, nC in expired:
+            self.retryOrFail(shape, nT, nC, 'Lease expired', now)
+
+    def retryOrFail(self, shape, nCubeTypes, nColors, log, now):
+        """ sets a task back to pending, or to failed if it used up its attempts (call in a transaction) """
+        self.db.execute(
+            '''UPDATE tasks SET state = CASE WHEN attempts < (SELECT maxAttempts FROM shapes WHERE shape=?)
+            THEN 'pending' ELSE 'failed' END, worker=NULL, leaseExpires=NULL, log=?, updated=?
+            WHERE shape=? AND nCubeTypes=? AND nColors=?''',
+            (shape, log, now, shape, nCubeTypes, nColors)
+        )
+        self.updateShape(shape, now)
+
+    def heartbeat(self, task, worker, leaseSeconds=60):
+        """Renew the lease of a running task
+
+        Returns:
+            bool: False if the task was cancelled or handed to another worker, so it should be stopped
+        """
+        now = time.time()
+        with self.transaction():
+            n = self.db.execute(
+                '''UPDATE tasks SET leaseExpires=?, updated=? WHERE shape=? AND nCubeTypes=?
+                AND nColors=? AND worker=? AND state='running' ''',
+                (now + leaseSeconds, now, task['shape'], task['nCubeTypes'], task['nColors'], worker)
+            ).rowcount
+        return n > 0
+
+    def complete(self, task, status, result, log):
+        """Post the result of a task. Results of tasks that were cancelled in
+        the meantime are dropped. 'ERROR' results are retried.
+        """
+        now = time.time()
+        key = (task['shape'], task['nCubeTypes'], task['nColors'])
+        with self.transaction():
+            state = self.db.execute(
+                'SELECT state FROM tasks WHERE shape=? AND nCubeTypes=? AND nColors=?', key
+            ).fetchone()[0]
+            if state not in ('pending', 'running'):
+                return
+            if status == 'ERROR':
+                self.retryOrFail(*key, log, now)
+                return
+            self.db.execute(
+                '''UPDATE tasks SET state='done', worker=NULL, leaseExpires=NULL, status=?, result=?, log=?, updated=?
+                WHERE shape=? AND nCubeTypes=? AND nColors=?''',
+                (status, json.dumps(result), log, now) + key
+            )
+            if status == 'SAT':
+                # Points with at least as many species and colors are not needed
+                self.db.execute(
+                    '''UPDATE tasks SET state='cancelled', updated=? WHERE shape=? AND nCubeTypes>=?
+                    AND nColors>=? AND state IN ('pending', 'running')''',
+                    (now,) + key
+                )
+            self.updateShape(task['shape'], now)
+
+    def updateShape(self, shape, now):
+        """ settles the shape if its minimal rule is known, or if it has no tasks left (call in a transaction) """
+        tasks = self.db.execute(
+            'SELECT nCubeTypes, nColors, state, status, result FROM tasks WHERE shape=?', (shape,)
+        ).fetchall()
+        results = {(nT, nC): (status, result) for nT, nC, state, status, result in tasks if state in ('done', 'failed')}
+        failed = sorted((nT, nC) for nT, nC, state, _, _ in tasks if state == 'failed')
+        # As in MinimalRuleSearch, a rule is final once all simpler points are ruled
+        # out, or failed, in which case it may not be the minimal rule
+        for nCubeTypes, nColors in sorted(k for k, (status, _) in results.items() if status == 'SAT'):
+            simpler = []
+            for key in smartEnumerate(nCubeTypes, nColors):
+                if not key in results:
+                    break
+                status, result = results[key]
+                if status == 'SAT':
+                    self.settle(shape, json.loads(result), [k for k in simpler if k in failed], now)
+                    return
+                simpler.append(key)
+        if not any(state in ('pending', 'running') for _, _, state, _, _ in tasks):
+            self.settle(shape, None, failed, now)
+
+    def settle(self, shape, minimalRule, unproven, now):
+        self.db.execute(
+            'UPDATE shapes SET settled=1, minimalRule=?, unproven=? WHERE shape=?',
+            (minimalRule, json.dumps(unproven), shape)
+        )
+        self.db.execute(
+            "UPDATE tasks SET state='cancelled', updated=? WHERE shape=? AND state IN ('pending', 'running')",
+            (now, shape)
+        )
+
+    def isFinished(self):
+        """ whether all shapes are settled (expired leases are handed out again first) """
+        with self.transaction():
+            self.expireLeases(time.time())
+        return self.db.execute('SELECT COUNT(*) FROM shapes WHERE settled=0').fetchone()[0] == 0
+
+    def summary(self):
+        """ task counts per state, and the minimal rule and the failed points
+        that could have held a smaller one if settled, for each shape """
+        shapes = {}
+        for shape, settled, minimalRule, unproven in self.db.execute('SELECT shape, settled, minimalRule, unproven FROM shapes'):
+            shapes[shape] = {'settled': bool(settled), 'minimalRule': minimalRule, 'unproven': json.loads(unproven or '[]')}
+        for shape, state, n in self.db.execute('SELECT shape, state, COUNT(*) FROM tasks GROUP BY shape, state'):
+            shapes[shape][state] = n
+        return shapes
+
+def runTask(task):
+    """ runs a claimed task, returning (status, result, log). The queue stores
+    the results itself, so the solve cache is not used """
+    with open(task['shape'], 'r') as f:
+        solveSpec = json.loads(f.read())
+    nT, nC = task['nCubeTypes'], task['nColors']
+    if task['method'] == 'findRuleFor':
+        _, rule, log = findRuleFor(
+            solveSpec['bindings'], nT, nC, task['nSolutions'],
+            solveSpec['nDim'], solveSpec['torsion'], cachePath=None
+        )
+        return ruleStatus(rule), rule, log
+    result = newSolve(task['shape'], nT, nC, cachePath=None)
+    return assemblyStatus(result), result, ''
+
+def runWorker(queuePath, leaseSeconds=60, pollSeconds=10):
+    """Claim and run tasks from the queue at queuePath until all shapes are
+    settled. Each task runs in a child process, which is terminated if the
+    task is cancelled (or handed to another worker) while it runs.
+
+    Args:
+        queuePath (str): Path to the SQLite file of the queue
+        leaseSeconds (int, optional): Time a task stays claimed without a heartbeat. Defaults to 60.
+        pollSeconds (int, optional): Time to wait before trying again when there are no pending tasks. Defaults to 10.
+    """
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    queue = SolveQueue(queuePath)
+    while True:
+        task = queue.claim(worker, leaseSeconds)
+        if task is None:
+            if queue.isFinished():
+                break
+            # Tasks that are still running may fail or expire
+            time.sleep(pollSeconds)
+            continue
+        print("{}: {} with {} cube types and {} colors (attempt {})".format(
+            worker, task['shape'], task['nCubeTypes'], task['nColors'], task['attempt']), flush=True)
+        recv, send = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=jobWorker, args=(send, runTask, (task,)), daemon=True)
+        process.start()
+        send.close()
+        cancelled = False
+        # Renew the lease a few times per lease period while waiting for the result
+        while not recv.poll(leaseSeconds / 3):
+            if not queue.heartbeat(task, worker, leaseSeconds):
+                cancelled = True
+                break
+        if cancelled:
+            print("{}: cancelled".format(worker), flush=True)
+            process.terminate()
+        else:
+            try:
+                ok, value = recv.recv()
+            except EOFError:
+                ok, value = False, 'Solver process exited with code {}'.format(process.exitcode)
+            if ok:
+                status, result, log = value
+            else:
+                status, result, log = 'ERROR', None, value
+            print("{}: {}".format(worker, status), flush=True)
+            queue.complete(task, status, result, log)
+        process.join()
+        recv.close()
+    queue.close()
+
+if __name__ == '__main__':
+    usage = '''Usage:
+    python solveQueue.py add queue.sqlite shape.json [maxCubeTypes maxColors]
+    python solveQueue.py work queue.sqlite [nWorkers]
+    python solveQueue.py status queue.sqlite'''
+    if len(sys.argv) < 3:
+        print(usage)
+        sys.exit(2)
+    mode, queuePath = sys.argv[1:3]
+    if mode == 'add' and len(sys.argv) > 3:
+        queue = SolveQueue(queuePath)
+        if len(sys.argv) > 5:
+            queue.addShape(sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
+        else:
+            queue.addShape(sys.argv[3])
+        queue.close()
+    elif mode == 'work':
+        nWorkers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+        workers = [multiprocessing.Process(target=runWorker, args=(queuePath,)) for _ in range(nWorkers)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+    elif mode == 'status':
+        queue = SolveQueue(queuePath)
+        for shape, summary in queue.summary().items():
+            print(shape, json.dumps(summary))
+            if summary['unproven']:
+                print('Not proven minimal: {} failed'.format(formatPoints(summary['unproven'])))
+        queue.close()
+    else:
+        print(usage)
+        sys.exit(2)
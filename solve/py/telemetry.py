@@ -0,0 +1,65 @@
+import os
+import json
+import time
+import resource
+import contextlib
+
+## Machine-readable records of where the time of each solve job goes
+
+def peakRSS():
+    """ peak resident set size of this process, in MB """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return maxrss / (1 << 20) if os.uname().sysname == 'Darwin' else maxrss / (1 << 10)
+
+class JobTelemetry:
+    """
+    Collects timings and counts for one (shape, nCubeTypes, nColors) job,
+    and appends them as one line of JSON to path when finished. With
+    path 'auto', the path is taken from the POLYCUBES_TELEMETRY environment
+    variable. If there is no path, nothing is written.
+    """
+    def __init__(self, path='auto', **fields):
+        if path == 'auto':
+            path = os.environ.get('POLYCUBES_TELEMETRY')
+        self.path = path
+        self.start = time.time()
+        self.record = {
+            'encodingSeconds': 0.0,
+            'solverSeconds': 0.0,
+            'validationSeconds': 0.0,
+            'candidates': 0,
+            'pid': os.getpid(),
+            'jobID': os.environ.get('SLURM_JOB_ID') or os.environ.get('JOB_ID')
+        }
+        self.record.update(fields)
+
+    @contextlib.contextmanager
+    def timed(self, key):
+        """ adds the time spent in the with block to record[key] """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record[key] = self.record.get(key, 0.0) + time.time() - start
+
+    def count(self, key, n=1):
+        self.record[key] = self.record.get(key, 0) + n
+
+    def encoded(self, mysat):
+        """ records the size of the formula of polysat instance mysat """
+        self.record['variables'] = mysat.nVars
+        self.record['clauses'] = len(mysat.basic_sat_clauses)
+        self.record['clauseFamilies'] = mysat.clause_family_counts()
+
+    def finish(self, **fields):
+        """ adds the final fields (such as status and result) and writes the record """
+        self.record.update(fields)
+        self.record['totalSeconds'] = time.time() - self.start
+        self.record['peakRSSMB'] = peakRSS()
+        self.record['finished'] = time.time()
+        if self.path:
+            # One write per record, so that concurrent jobs can share the file
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(self.record) + '\n')
+        return self.record
@@ -1,6 +1,7 @@
 from collections import Counter
 import numpy as np
 from scipy.spatial.transform import Rotation as R
+import os
 import json
 import numpy as np
 
@@ -188,33 +189,100 @@ def enumerateRotations():
         23: {0: 5, 1: 4, 2: 3, 3: 2, 4: 1, 5: 0}
     }
 
+## Rotation and orientation lookup tables, computed once at import so that
+## the solver does not have to compute them for every patch and rotation
+
+def computeRotationTable():
+    """ Get the patch that each patch rotates to under each rotation
+
+    Returns:
+        array: int32 array of shape (24, 6), indexed [rotation, patch]
+    """
+    rotations = enumerateRotations()
+    return np.array([[rotations[r][p] for p in range(6)] for r in range(len(rotations))], dtype=np.int32)
+
+def computePatchRotVecTable():
+    """ Get patchRotToVec for each patch and rotation state
+
+    Returns:
+        array: int32 array of shape (6, 4, 3), indexed [patch, rotation state]
+    """
+    return np.array([[patchRotToVec(p, o) for o in range(4)] for p in range(6)]).astype(np.int32)
+
+def computeOrientationTable(rotationTable, patchRotVecTable):
+    """ Get the rotation state that each patch rotation state changes to
+    when the patch is rotated
+
+    Args:
+        rotationTable (array): As given by computeRotationTable
+        patchRotVecTable (array): As given by computePatchRotVecTable
+
+    Returns:
+        array: int32 array of shape (24, 6, 4), indexed [rotation, patch, rotation state]
+    """
+    ruleOrder = np.array(getRuleOrder())
+    table = np.empty(rotationTable.shape + (4,), dtype=np.int32)
+    for r in range(rotationTable.shape[0]):
+        for p in range(6):
+            pRot = rotationTable[r, p]
+            for o in range(4):
+                # The patch pointing the way of the rotation vector is
+                # rotated along with it, which gives the rotated vector
+                pTemp = getIndexOf(patchRotVecTable[p, o], ruleOrder)
+                vRot = ruleOrder[rotationTable[r, pTemp]]
+                table[r, p, o] = getIndexOf(vRot, patchRotVecTable[pRot])
+    return table
+
+rotationTable = computeRotationTable()
+patchRotVecTable = computePatchRotVecTable()
+orientationTable = computeOrientationTable(rotationTable, patchRotVecTable)
+for table in (rotationTable, patchRotVecTable, orientationTable):
+    # Shared by all users of the module
+    table.setflags(write=False)
 
 def topFromFile(path, nDim=3):
-    neigbourDirs = getRuleOrder(nDim)
+    """ Get the topology of a shape given by the coordinates of its cubes.
+    Neighbours are found through an index of the positions (a dense voxel
+    grid, or a dict if the shape is too sparse for one), so this takes
+    linear time in the number of cubes
 
-    coords = [np.array(i) for i in coordsFromFile(path)]
-    top = []
-    empty = []
-    donePairs = []  # Keep track so that only one bond per pair is saved
-
-    # For each position
-    for i, current in enumerate(coords):
-        # Enumerate von Neumann neighborhood
-        for dPi, dP in enumerate(neigbourDirs):
-            neigbourPos = current + dP
-            found = False
-            # Check if current neighbor is among the positions
-            for j, other in enumerate(coords):
-                if (neigbourPos == other).all():
-                    if not (j, i) in donePairs:
-                        top.append((
-                                i, dPi,
-                                j, dPi + (1 if dPi % 2 == 0 else -1)))
-                        donePairs.append((i, j))
-                    found = True
-            # If the current neigbour is empty, save
-            if not found:
-                empty.append((i, dPi))
+    Args:
+        path: Path to a file with one "(x,y,z)" coordinate per line, or an array-like of shape (n, 3) (or (n, 2) for 2D)
+        nDim (int, optional): Number of dimensions. Defaults to 3.
+
+    Returns:
+        tuple: The bindings [(i, dPi, j, dPj)], with each bound pair listed once, and the empty patches [(i, dPi)]
+    """
+    if isinstance(path, (str, os.PathLike)):
+        path = coordsFromFile(path)
+    if len(path) == 0:
+        return [], []
+    coords = np.asarray(path, dtype=np.int64).reshape(len(path), -1)
+    if coords.shape[1] < 3:
+        coords = np.pad(coords, ((0, 0), (0, 3 - coords.shape[1])))
+    neigbourDirs = np.array(getRuleOrder(nDim))
+    n = len(coords)
+
+    # Neighbour positions, indexed [cube, patch, axis]
+    neighbourPos = coords[:, None, :] + neigbourDirs[None, :, :]
+    # Pad by one, so that all neighbours are inside the grid
+    lower = coords.min(axis=0) - 1
+    size = coords.max(axis=0) - lower + 2
+    if np.prod(size) <= 8 * n + 1000:
+        grid = np.full(size, -1, dtype=np.int64)
+        grid[tuple((coords - lower).T)] = np.arange(n)
+        neighbours = grid[tuple(np.moveaxis(neighbourPos - lower, -1, 0))]
+    else:
+        index = {p: i for i, p in enumerate(map(tuple, coords.tolist()))}
+        neighbours = np.array([index.get(p, -1) for p in map(tuple, neighbourPos.reshape(-1, 3).tolist())],
+            dtype=np.int64).reshape(n, len(neigbourDirs))
+
+    # Only keep one bond per pair, listed from the cube with the lower index
+    i, dPi = np.nonzero(neighbours > np.arange(n)[:, None])
+    j = neighbours[i, dPi]
+    dPj = dPi + np.where(dPi % 2 == 0, 1, -1)
+    top = list(zip(i.tolist(), dPi.tolist(), j.tolist(), dPj.tolist()))
+    empty = list(zip(*(a.tolist() for a in np.nonzero(neighbours < 0))))
     return top, empty
 
 def calcEmptyFromTop(top):
@@ -228,27 +296,56 @@ def calcEmptyFromTop(top):
                 empty.append((i,dPi))
     return empty
 
-def merge(i, j, pmaps, dPi):
-    others = [m for mi, m in enumerate(pmaps) if not mi in [i,j]]
-    jMoved = {k: v+dPi for k,v in pmaps[j].items()}
-    merged = {**jMoved, **pmaps[i]}
-    return others + [merged]
+def calcComponentsFromTop(top, nDim=3):
+    """ Find the connected shapes of a topology, and the coordinates of their
+    particles, with a breadth-first search over the bindings. Takes linear
+    time in the number of particles and bindings
 
-def calcCoordmapFromTop(top, nDim=3):
-    dirs = getRuleOrder(nDim)
-    indices = set(v for i,_,j,__ in top for v in [i, j])
-    pmaps = [{i: np.array([0, 0, 0])} for i in indices]
+    Args:
+        top: Topology, as a list of bindings [particle1, patch1, particle2, patch2]
+        nDim (int, optional): Number of dimensions. Defaults to 3.
 
-    for i, dPi, j, dPj in top:
-        iIdx = [i in m.keys() for m in pmaps].index(True)
-        jIdx = [j in m.keys() for m in pmaps].index(True)
-        pmaps = merge(iIdx,jIdx, pmaps, pmaps[iIdx][i] + dirs[dPi] - pmaps[jIdx][j])
+    Returns:
+        list: (particle ids, coordinates) per connected shape, as int arrays of
+        shape (n,) and (n, 3), ordered by their lowest particle id, which is
+        placed at the origin
+    """
+    dirs = [tuple(int(x) for x in d) for d in getRuleOrder(nDim)]
+    neighbours = {}
+    for i, dPi, j, _ in top:
+        d = dirs[dPi]
+        neighbours.setdefault(i, []).append((j, d))
+        neighbours.setdefault(j, []).append((i, (-d[0], -d[1], -d[2])))
+
+    positions = {}
+    components = []
+    for start in sorted(neighbours):
+        if start in positions:
+            continue
+        positions[start] = (0, 0, 0)
+        ids = [start]
+        k = 0
+        while k < len(ids):
+            i = ids[k]
+            k += 1
+            x, y, z = positions[i]
+            for j, (dx, dy, dz) in neighbours[i]:
+                if j not in positions:
+                    positions[j] = (x + dx, y + dy, z + dz)
+                    ids.append(j)
+        components.append((
+            np.array(ids, dtype=np.int64),
+            np.array([positions[i] for i in ids], dtype=np.int64)
+        ))
+    return components
 
-    return pmaps
+def calcCoordmapFromTop(top, nDim=3):
+    """ Get the position of each particle, as one {particle id: coordinates} dict per connected shape (see calcComponentsFromTop) """
+    return [dict(zip(ids.tolist(), coords)) for ids, coords in calcComponentsFromTop(top, nDim)]
 
 def calcCoordsFromTop(top, nDim=3):
-    pmaps = calcCoordmapFromTop(top, nDim=nDim)
-    return [np.array([v for v in posmap.values()]).T for posmap in pmaps]
+    """ Get the coordinates of each connected shape, as arrays of shape (3, n) (see calcComponentsFromTop) """
+    return [coords.T for _, coords in calcComponentsFromTop(top, nDim)]
 
 def countParticlesAndBindings(topology):
     pidsa = [x[0] for x in topology]